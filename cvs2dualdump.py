@@ -0,0 +1,160 @@
+#!/usr/local/bin/python
+
+#
+# Copyright (c) 2012 YASUOKA Masahiko <yasuoka@yasuoka.net>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Usage
+#
+#   First import to both git and svn:
+#   % python cvs2dualdump.py -k OpenBSD -e openbsd.org /cvs/openbsd/src \
+#       openbsd.git.dump openbsd.svn.dump
+#   % git init --bare /git/openbsd.git
+#   % git --git-dir /git/openbsd.git fast-import < openbsd.git.dump
+#   % svnadmin create /svnrepo
+#   % svnadmin load /svnrepo < openbsd.svn.dump
+#
+
+import getopt
+import sys
+
+import cvs2gitdump
+import cvs2svndump
+
+from cvs2gitdump import CHANGESET_FUZZ_SEC, CvsConv, RcsKeywords, output
+
+
+def usage():
+    print('usage: cvs2dualdump [-ah] [-z fuzz] [-e email_domain] '
+          '[-E log_encodings]\n'
+          '\t[-k rcs_keywords] [-b branch] [-m module] '
+          'cvsroot git_dump svn_dump', file=sys.stderr)
+
+
+def main():
+    email_domain = None
+    git_branch = 'master'
+    dump_all = False
+    log_encoding = 'utf-8,iso-8859-1'
+    rcs = RcsKeywords()
+    modules = []
+    fuzzsec = CHANGESET_FUZZ_SEC
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ab:hm:z:e:E:k:')
+        for opt, v in opts:
+            if opt == '-z':
+                fuzzsec = int(v)
+            elif opt == '-e':
+                email_domain = v
+            elif opt == '-a':
+                dump_all = True
+            elif opt == '-b':
+                git_branch = v
+            elif opt == '-E':
+                log_encoding = v
+            elif opt == '-k':
+                rcs.add_id_keyword(v)
+            elif opt == '-m':
+                if v == '.git':
+                    print('Cannot handle the path named \'.git\'',
+                          file=sys.stderr)
+                    sys.exit(1)
+                modules.append(v)
+            elif opt == '-h':
+                usage()
+                sys.exit(1)
+    except getopt.GetoptError as msg:
+        print(msg, file=sys.stderr)
+        usage()
+        sys.exit(1)
+
+    if len(args) != 3:
+        usage()
+        sys.exit(1)
+
+    log_encodings = log_encoding.split(',')
+
+    cvsroot = args[0]
+    while cvsroot[-1] == '/':
+        cvsroot = cvsroot[:-1]
+
+    # the walk doesn't dump blobs, they are dumped with the commits
+    cvs = CvsConv(cvsroot, rcs, False, fuzzsec, log_encodings)
+    print('** walk cvs tree', file=sys.stderr)
+    if len(modules) == 0:
+        cvs.walk()
+    else:
+        for module in modules:
+            cvs.walk(module)
+
+    changesets = sorted(cvs.changesets)
+    nchangesets = len(changesets)
+    print('** cvs has %d changeset' % (nchangesets), file=sys.stderr)
+
+    if nchangesets <= 0:
+        sys.exit(0)
+
+    if not dump_all:
+        # don't use last 10 minutes for safety
+        max_time_max = changesets[-1].max_time - 600
+    else:
+        max_time_max = changesets[-1].max_time
+
+    gitout = open(args[1], 'w', encoding='utf-8', newline='')
+    svnout = open(args[2], 'w', encoding='utf-8', newline='')
+    svn = cvs2svndump.SvnDumper()
+    svn.dump = True
+    svn.out = svnout
+
+    output('SVN-fs-dump-format-version: 2', file=svnout)
+    output('', file=svnout)
+
+    markseq = 0
+    for chg_idx, k in enumerate(changesets):
+        if k.max_time > max_time_max:
+            break
+
+        log = cvs.logs.get(k.log_key)
+        email = k.author if email_domain is None \
+            else k.author + '@' + email_domain
+
+        cvs2svndump.svn_dump_revision(
+            chg_idx + 1, email, k.min_time, log.decode('utf-8'),
+            file=svnout)
+
+        # check out each revision once and write it to both
+        conts = []
+        for f in k.revs:
+            cf = cvs.files[f.file]
+            cont = None
+            if f.state != 'dead':
+                cont = cvs2gitdump.git_expand(cf.path, f.rev, rcs)
+            conts.append(cont)
+            cvs2svndump.svn_dump_node(
+                svn, cf.name, cf.executable, cont, file=svnout)
+        markseq = cvs2gitdump.git_dump_changeset(
+            cvs, k, conts, markseq, git_branch, email_domain, None, set(),
+            file=gitout)
+
+    gitout.close()
+    svnout.close()
+    print('** dumped', file=sys.stderr)
+
+
+# ----------------------------------------------------------------------
+# entry point
+# ----------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
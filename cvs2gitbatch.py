@@ -0,0 +1,301 @@
+#!/usr/local/bin/python
+
+#
+# Copyright (c) 2012 YASUOKA Masahiko <yasuoka@yasuoka.net>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Usage
+#
+#   % cat manifest
+#   # cvsroot              git_dir            branch  options
+#   /cvs/openbsd/src       /git/src.git       master  -k OpenBSD -m bin
+#   /cvs/openbsd/xenocara  /git/xenocara.git  master  -k OpenBSD
+#   % python cvs2gitbatch.py -j 4 -M 16384 -l /var/log/cvs2git manifest
+#
+
+import getopt
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+CVS2GITDUMP = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'cvs2gitdump.py')
+
+# the memory budget of a conversion is estimated from the size of the ,v
+# files, the metadata of the revisions and the buffers of the dump
+MEMORY_BASE = 512 * 1024 * 1024
+MEMORY_RATIO = 4                # bytes of ,v files per byte of memory
+
+# set the limit of the address space, then exec the dump.  preexec_fn
+# isn't safe in the threads.
+LIMITED_EXEC = ('import os, resource, sys; '
+                'n = int(sys.argv[1]); '
+                'resource.setrlimit(resource.RLIMIT_AS, (n, n)); '
+                'os.execv(sys.executable, [sys.executable] + sys.argv[2:])')
+
+
+def usage():
+    print('usage: cvs2gitbatch [-h] [-j jobs] [-l log_dir] [-M memory_limit] '
+          'manifest', file=sys.stderr)
+
+
+def main():
+    jobs = os.cpu_count() or 1
+    log_dir = '.'
+    memory_limit = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hj:l:M:')
+        for opt, v in opts:
+            if opt == '-j':
+                jobs = int(v)
+            elif opt == '-l':
+                log_dir = v
+            elif opt == '-M':
+                memory_limit = int(v) * 1024 * 1024
+            elif opt == '-h':
+                usage()
+                sys.exit(1)
+    except getopt.GetoptError as msg:
+        print(msg, file=sys.stderr)
+        usage()
+        sys.exit(1)
+
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+    if memory_limit is not None and not hasattr(resource, 'RLIMIT_AS'):
+        print('-M isn\'t supported on this platform', file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        repos = read_manifest(args[0])
+    except ValueError as msg:
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+    os.makedirs(log_dir, exist_ok=True)
+
+    # start the largest repositories first, they decide the total time
+    for r in repos:
+        r.size = repo_size(r)
+        if memory_limit is not None:
+            r.budget = min(MEMORY_BASE + r.size // MEMORY_RATIO,
+                           memory_limit)
+    repos.sort(key=lambda r: r.size, reverse=True)
+
+    start = time.time()
+    Scheduler(jobs, memory_limit).run(repos, log_dir)
+    elapsed = time.time() - start
+
+    report(repos, elapsed)
+    if any(r.status != 'ok' for r in repos):
+        sys.exit(1)
+
+
+class Scheduler:
+    """Run the conversions by at most jobs threads.  A conversion is
+    started only while the sum of the memory budgets of the running
+    conversions stays within the memory limit, the first pending one which
+    fits is started.  A conversion is always started when nothing runs."""
+
+    def __init__(self, jobs, memory_limit):
+        self.jobs = jobs
+        self.memory_limit = memory_limit
+        self.cond = threading.Condition()
+        self.running = 0
+        self.used = 0
+
+    def run(self, repos, log_dir):
+        pending = list(repos)
+        threads = []
+        with self.cond:
+            while len(pending) > 0:
+                r = self.admit(pending)
+                if r is None:
+                    self.cond.wait()
+                    continue
+                pending.remove(r)
+                self.running = self.running + 1
+                self.used = self.used + r.budget
+                t = threading.Thread(target=self.convert, args=(r, log_dir))
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+
+    def admit(self, pending):
+        if self.running >= self.jobs:
+            return None
+        for r in pending:
+            if self.memory_limit is None or self.running == 0 or \
+                    self.used + r.budget <= self.memory_limit:
+                return r
+        return None
+
+    def convert(self, r, log_dir):
+        try:
+            r.convert(log_dir, r.budget if self.memory_limit else None)
+        finally:
+            with self.cond:
+                self.running = self.running - 1
+                self.used = self.used - r.budget
+                self.cond.notify()
+
+
+class Repository:
+    def __init__(self, name, cvsroot, git_dir, branch, options):
+        self.name = name
+        self.cvsroot = cvsroot
+        self.git_dir = git_dir
+        self.branch = branch
+        self.options = options
+        self.size = 0
+        self.budget = 0
+        self.status = 'waiting'
+        self.commits = 0
+        self.elapsed = 0
+
+    def modules(self):
+        mods = []
+        for i, opt in enumerate(self.options):
+            if opt == '-m' and i + 1 < len(self.options):
+                mods.append(self.options[i + 1])
+            elif opt.startswith('-m') and len(opt) > 2:
+                mods.append(opt[2:])
+        return mods
+
+    def convert(self, log_dir, limit):
+        start = time.time()
+        self.status = 'running'
+        with open(os.path.join(log_dir, self.name + '.log'), 'w') as log:
+            try:
+                self.status = self.run(log, limit)
+            except Exception as e:
+                print(e, file=log)
+                self.status = 'failed'
+        self.elapsed = time.time() - start
+
+    def run(self, log, limit):
+        if not os.path.isdir(self.git_dir):
+            if git(log, 'init', '--bare', self.git_dir) != 0:
+                return 'failed'
+        before = self.count_commits()
+
+        args = [CVS2GITDUMP, '-b', self.branch] + self.options + \
+            [self.cvsroot]
+        if before is not None:
+            args.append(self.git_dir)
+        else:
+            before = 0
+
+        print('** ' + ' '.join(shlex.quote(a) for a in args), file=log)
+        if limit is None:
+            args = [sys.executable] + args
+        else:
+            print('** the address space is limited to %dMB' % (
+                limit // 1048576), file=log)
+            args = [sys.executable, '-c', LIMITED_EXEC, str(limit)] + args
+        log.flush()
+        dump = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=log)
+        imp = subprocess.Popen(['git', '--git-dir=' + self.git_dir,
+                                'fast-import', '--quiet'],
+                               stdin=dump.stdout, stderr=log)
+        dump.stdout.close()
+        imp.wait()
+        dump.wait()
+        if dump.returncode != 0 or imp.returncode != 0:
+            return 'failed'
+        after = self.count_commits()
+        self.commits = (after or 0) - before
+        return 'ok'
+
+    def count_commits(self):
+        # None if the branch doesn't exist yet
+        git = subprocess.Popen(
+            ['git', '--git-dir=' + self.git_dir, 'rev-list', '--count',
+             'refs/heads/' + self.branch], encoding='utf-8',
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        outs = git.stdout.read()
+        git.wait()
+        if git.returncode != 0:
+            return None
+        return int(outs.strip())
+
+
+def git(log, *args):
+    return subprocess.call(('git',) + args, stdout=log, stderr=log)
+
+
+def read_manifest(path):
+    repos = []
+    names = set()
+    with open(path, encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            fields = shlex.split(line, comments=True)
+            if len(fields) == 0:
+                continue
+            if len(fields) < 3:
+                raise ValueError('%s:%d: cvsroot, git_dir and branch are '
+                                 'required' % (path, lineno))
+            name = os.path.basename(fields[1].rstrip('/'))
+            if name.endswith('.git'):
+                name = name[:-4]
+            while name in names:
+                name = name + '_'
+            names.add(name)
+            repos.append(Repository(name, fields[0].rstrip('/'), fields[1],
+                                    fields[2], fields[3:]))
+    return repos
+
+
+def repo_size(r):
+    size = 0
+    paths = [os.path.join(r.cvsroot, m) for m in r.modules()] or [r.cvsroot]
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for f in files:
+                if f[-2:] == ',v':
+                    try:
+                        size += os.stat(os.path.join(root, f)).st_size
+                    except OSError:
+                        pass
+    return size
+
+
+def report(repos, elapsed):
+    print('%-20s %-7s %10s %8s %9s %9s' % (
+        'repository', 'status', 'size(MB)', 'commits', 'time(s)',
+        'commit/s'), file=sys.stderr)
+    total = 0
+    for r in repos:
+        total += r.commits
+        print('%-20s %-7s %10.1f %8d %9.1f %9.1f' % (
+            r.name, r.status, r.size / 1048576.0, r.commits, r.elapsed,
+            r.commits / r.elapsed if r.elapsed > 0 else 0), file=sys.stderr)
+    nfailed = sum(1 for r in repos if r.status != 'ok')
+    print('** %d repositories, %d failed, %d commits in %.1f seconds '
+          '(%.1f commit/s)' % (
+              len(repos), nfailed, total, elapsed,
+              total / elapsed if elapsed > 0 else 0), file=sys.stderr)
+
+
+# ----------------------------------------------------------------------
+# entry point
+# ----------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
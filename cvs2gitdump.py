@@ -30,22 +30,66 @@
 #   % git --git-dir /git/openbsd.git fast-import < openbsd2.dump
 #
 
+import asyncio
+import bz2
+import calendar
+import collections
+import functools
 import getopt
+import gzip
+import io
+import json
+import lzma
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import shutil
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha1
+
 import rcsparse
 
 CHANGESET_FUZZ_SEC = 300
+CHECKPOINT_INTERVAL = 1000
+PIPELINE_DEPTH = 16
+PIPELINE_BYTES = 256 * 1024 * 1024
+COMPRESS_CHUNK = 4 * 1024 * 1024
+# the revisions older than this many fuzz windows before the last dumped
+# changeset are dropped by the incremental walk
+HORIZON_FUZZ = 10
+CONTENT_CACHE_SIZE = 4096   # megabytes
+PREFETCH_JOBS = 4
+COMPRESSORS = {
+    'gzip': functools.partial(gzip.compress, mtime=0),
+    'bz2': bz2.compress,
+    'xz': lzma.compress,
+}
 
 
 def usage():
     print('usage: cvs2gitdump [-ah] [-z fuzz] [-e email_domain] '
           '[-E log_encodings]\n'
           '\t[-k rcs_keywords] [-b branch] [-m module] [-l last_revision]\n'
-          '\tcvsroot [git_dir]', file=sys.stderr)
+          '\t[-s state_file] [-c checkpoint_file] [-n checkpoint_interval]\n'
+          '\t[-p jobs] [-j jobs] [--export-blobs=file] '
+          '[--import-blobs=file]\n'
+          '\t[--pack=git_dir] [-S snapshot_file] [-V verify_file] '
+          '[-Z compression]\n'
+          '\t[--since=time] [--until=time] [-C cache_dir] '
+          '[--cache-size=megabytes]\n'
+          '\t[--prefetch=megabytes] cvsroot [git_dir]\n'
+          '       cvs2gitdump -A snapshot_file [-z fuzz] [-E log_encodings] '
+          '[-m module]', file=sys.stderr)
 
 
 def main():
@@ -56,12 +100,33 @@ def main():
     dump_all = False
     log_encoding = 'utf-8,iso-8859-1'
     rcs = RcsKeywords()
+    keywords = []
     modules = []
     last_revision = None
+    state_file = None
+    checkpoint_file = None
+    checkpoint_interval = CHECKPOINT_INTERVAL
+    jobs = None
+    shard_jobs = None
+    export_blobs = None
+    import_blobs = None
+    save_snapshot = None
+    load_snapshot = None
+    verify_file = None
+    compression = None
+    pack_dir = None
+    since = None
+    until = None
+    cache_dir = None
+    cache_size = CONTENT_CACHE_SIZE
+    prefetcher = None
     fuzzsec = CHANGESET_FUZZ_SEC
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'ab:hm:z:e:E:k:t:l:')
+        opts, args = getopt.getopt(
+            sys.argv[1:], 'aA:b:c:C:hj:m:n:p:z:e:E:k:t:l:s:S:V:Z:',
+            ['export-blobs=', 'import-blobs=', 'pack=', 'since=', 'until=',
+             'cache-size=', 'prefetch='])
         for opt, v in opts:
             if opt == '-z':
                 fuzzsec = int(v)
@@ -75,6 +140,7 @@ def main():
                 log_encoding = v
             elif opt == '-k':
                 rcs.add_id_keyword(v)
+                keywords.append(v)
             elif opt == '-m':
                 if v == '.git':
                     print('Cannot handle the path named \'.git\'',
@@ -83,145 +149,520 @@ def main():
                 modules.append(v)
             elif opt == '-l':
                 last_revision = v
+            elif opt == '-s':
+                state_file = v
+            elif opt == '-c':
+                checkpoint_file = v
+            elif opt == '-n':
+                checkpoint_interval = int(v)
+            elif opt == '-p':
+                jobs = int(v)
+            elif opt == '-j':
+                shard_jobs = int(v)
+            elif opt == '-S':
+                save_snapshot = v
+            elif opt == '-V':
+                verify_file = v
+            elif opt == '-A':
+                load_snapshot = v
+            elif opt == '-Z':
+                if v not in COMPRESSORS:
+                    print('Unknown compression: %s' % (v), file=sys.stderr)
+                    sys.exit(1)
+                compression = v
+            elif opt == '--export-blobs':
+                export_blobs = v
+            elif opt == '--import-blobs':
+                import_blobs = v
+            elif opt == '--pack':
+                pack_dir = v
+            elif opt == '--since':
+                since = parse_time(v)
+            elif opt == '--until':
+                until = parse_time(v)
+            elif opt == '-C':
+                cache_dir = v
+            elif opt == '--cache-size':
+                cache_size = int(v)
+            elif opt == '--prefetch':
+                prefetcher = Prefetcher(int(v) * 1048576)
             elif opt == '-h':
                 usage()
                 sys.exit(1)
-    except getopt.GetoptError as msg:
+    except (getopt.GetoptError, ValueError) as msg:
         print(msg, file=sys.stderr)
         usage()
         sys.exit(1)
 
-    if len(args) == 0 or len(args) > 2:
+    if (len(args) == 0 and load_snapshot is None) or len(args) > 2 or \
+            (verify_file is not None and len(args) != 2):
         usage()
         sys.exit(1)
+    if shard_jobs is not None and (jobs is not None or
+                                   checkpoint_file is not None):
+        print('-j can\'t be used with -p or -c', file=sys.stderr)
+        sys.exit(1)
+    if import_blobs is not None and len(args) != 2:
+        # the blobs are checked against the git repository
+        print('--import-blobs needs the git repository', file=sys.stderr)
+        sys.exit(1)
+    if compression is not None and checkpoint_file is not None:
+        # the compressed output can't be rewound to the checkpoint
+        print('-Z can\'t be used with -c', file=sys.stderr)
+        sys.exit(1)
+    if pack_dir is not None and (len(args) != 1 or jobs is not None or
+                                 checkpoint_file is not None or
+                                 compression is not None):
+        print('--pack is only for the first import and can\'t be used with '
+              '-p, -c or -Z', file=sys.stderr)
+        sys.exit(1)
+    if since is not None and len(args) != 1:
+        print('--since is only for the first import', file=sys.stderr)
+        sys.exit(1)
 
     log_encodings = log_encoding.split(',')
 
+    if load_snapshot is not None:
+        # cluster the revisions from the snapshot, and report it
+        cvs = CvsConv(None, rcs, False, fuzzsec, log_encodings)
+        cvs.load_snapshot(load_snapshot, modules)
+        changesets = sorted(cvs.changesets)
+        analyze(cvs, changesets)
+        print('logs: %d, decoded by %s' % (len(cvs.logs.logs), ', '.join(
+            '%s: %d' % (e, n)
+            for e, n in zip(log_encodings, cvs.logs.nmatched))))
+        sys.exit(0)
+
     cvsroot = args[0]
     while cvsroot[-1] == '/':
         cvsroot = cvsroot[:-1]
 
+    if save_snapshot is not None:
+        # walk the tree without checking out
+        cvs = CvsConv(cvsroot, rcs, False, fuzzsec, log_encodings)
+        cvs.snapshot = Snapshot(cvsroot)
+        print('** walk cvs tree', file=sys.stderr)
+        if len(modules) == 0:
+            cvs.walk()
+        else:
+            for module in modules:
+                cvs.walk(module)
+        cvs.snapshot.save(save_snapshot)
+        print('** saved %d revisions of %d files' % (
+            len(cvs.snapshot.revs), len(cvs.snapshot.files)),
+            file=sys.stderr)
+        sys.exit(0)
+
     if len(args) == 2:
         do_incremental = True
-        git = subprocess.Popen(
-            ['git', '--git-dir=' + args[1], '-c',
-             'i18n.logOutputEncoding=UTF-8', 'log', '--max-count', '1',
-             '--date=raw', '--format=%ae%n%ad%n%H', git_branch],
-            encoding='utf-8', stdout=subprocess.PIPE)
-        outs = git.stdout.readlines()
-        git.wait()
-        if git.returncode != 0:
-            print("Couldn't exec git", file=sys.stderr)
-            sys.exit(git.returncode)
-        git_tip = outs[2].strip()
-
-        if last_revision is not None:
+        state = None
+        if state_file is not None and last_revision is None and \
+                os.path.exists(state_file):
+            # the state file keeps the author and the time of the last
+            # dumped changeset, git doesn't need to be asked if it has
+            # imported the commits.
+            state = check_state(state_file, args[1], git_branch)
+            if state is None:
+                print('** the state file doesn\'t match the branch, ask git',
+                      file=sys.stderr)
+        if state is not None:
+            git_tip, last_author, last_ctime = state
+        else:
             git = subprocess.Popen(
                 ['git', '--git-dir=' + args[1], '-c',
                  'i18n.logOutputEncoding=UTF-8', 'log', '--max-count', '1',
-                 '--date=raw', '--format=%ae%n%ad%n%H', last_revision],
+                 '--date=raw', '--format=%ae%n%ad%n%H', git_branch],
                 encoding='utf-8', stdout=subprocess.PIPE)
             outs = git.stdout.readlines()
             git.wait()
             if git.returncode != 0:
-                print("Coundn't exec git", file=sys.stderr)
+                print("Couldn't exec git", file=sys.stderr)
                 sys.exit(git.returncode)
-        last_author = outs[0].strip()
-        last_ctime = float(outs[1].split()[0])
-
-        # strip off the domain part from the last author since cvs doesn't have
-        # the domain part.
-        if do_incremental and email_domain is not None and \
-                last_author.lower().endswith(('@' + email_domain).lower()):
-            last_author = last_author[:-1 * (1 + len(email_domain))]
-
-    cvs = CvsConv(cvsroot, rcs, not do_incremental, fuzzsec)
-    print('** walk cvs tree', file=sys.stderr)
-    if len(modules) == 0:
-        cvs.walk()
-    else:
-        for module in modules:
-            cvs.walk(module)
-
-    changesets = sorted(cvs.changesets)
+            git_tip = outs[2].strip()
+
+            if last_revision is not None:
+                git = subprocess.Popen(
+                    ['git', '--git-dir=' + args[1], '-c',
+                     'i18n.logOutputEncoding=UTF-8', 'log', '--max-count',
+                     '1', '--date=raw', '--format=%ae%n%ad%n%H',
+                     last_revision],
+                    encoding='utf-8', stdout=subprocess.PIPE)
+                outs = git.stdout.readlines()
+                git.wait()
+                if git.returncode != 0:
+                    print("Coundn't exec git", file=sys.stderr)
+                    sys.exit(git.returncode)
+            last_author = outs[0].strip()
+            last_ctime = float(outs[1].split()[0])
+
+            # strip off the domain part from the last author since cvs
+            # doesn't have the domain part.
+            if email_domain is not None and last_author.lower().endswith(
+                    ('@' + email_domain).lower()):
+                last_author = last_author[:-1 * (1 + len(email_domain))]
+
+    if compression is not None:
+        compress_stdout(compression)
+
+    content_cache = None
+    if cache_dir is not None:
+        content_cache = ContentCache(cache_dir, rcs, cache_size * 1048576)
+        rcs.cache = content_cache
+
+    resume = None
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        resume = load_checkpoint(checkpoint_file)
+        if 'index' not in resume:
+            # the previous run stopped in the walk, dump the blobs again
+            print('** restart the walk', file=sys.stderr)
+            rewind_output(resume['offset'])
+            resume = None
+        else:
+            print('** resume from changeset %d' % (resume['index']),
+                  file=sys.stderr)
+    if checkpoint_file is not None and resume is None:
+        # the walk dumps the blobs, the output before them is kept
+        save_checkpoint(checkpoint_file, {})
+
+    blobs = None
+    if export_blobs is not None or import_blobs is not None:
+        blobs = BlobIndex(cvsroot)
+        if import_blobs is not None:
+            try:
+                blobs.load(import_blobs)
+                n = blobs.verify(args[1])
+            except (OSError, ValueError, KeyError) as msg:
+                print('Couldn\'t load the blobs: %s' % (msg), file=sys.stderr)
+                sys.exit(1)
+            if n > 0:
+                print('** %d blobs aren\'t in git, they are dumped again' % (
+                    n), file=sys.stderr)
+
+    horizon = None
+    if do_incremental and verify_file is None:
+        # the history before the last dumped changeset isn't dumped, keep
+        # only the recent revisions
+        horizon = last_ctime - HORIZON_FUZZ * fuzzsec
+    while True:
+        # the pipeline and the shards dump the blobs with the commits
+        cvs = CvsConv(cvsroot, rcs, not do_incremental and jobs is None and
+                      shard_jobs is None and pack_dir is None, fuzzsec,
+                      log_encodings)
+        if resume is not None:
+            # the blobs have been dumped already, only assign the marks
+            cvs.dumpblob = False
+        cvs.blobs = blobs
+        cvs.horizon = horizon
+        cvs.since = since
+        cvs.until = until
+        cvs.prefetcher = prefetcher
+        print('** walk cvs tree', file=sys.stderr)
+        if len(modules) == 0:
+            cvs.walk()
+        else:
+            cvs.walk_modules(modules, os.cpu_count() or 1, keywords)
+
+        changesets = sorted(cvs.changesets)
+        if horizon is None:
+            break
+        # a changeset near the horizon may have lost its older revisions,
+        # it must end before the last dumped changeset
+        if all(k.max_time < last_ctime for k in changesets
+               if k.min_time < horizon + fuzzsec):
+            print('** %d revisions before the horizon are skipped' % (
+                cvs.nold), file=sys.stderr)
+            break
+        print('** a changeset crosses the horizon, walk the whole history',
+              file=sys.stderr)
+        horizon = None
     nchangesets = len(changesets)
     print('** cvs has %d changeset' % (nchangesets), file=sys.stderr)
+    print('** %d logs are decoded by %s' % (len(cvs.logs.logs), ', '.join(
+        '%s: %d' % (e, n) for e, n in zip(log_encodings, cvs.logs.nmatched))),
+        file=sys.stderr)
 
     if nchangesets <= 0:
+        sys.stdout.close()
+        if len(cvs.baseline) > 0:
+            print('No changeset between --since and --until', file=sys.stderr)
+            sys.exit(1)
         sys.exit(0)
 
+    if len(cvs.baseline) > 0:
+        # the first commit carries the files as of --since, its own
+        # revisions follow and override them
+        changesets[0].revs[:0] = cvs.baseline
+        print('** %d files are in the baseline' % (len(cvs.baseline)),
+              file=sys.stderr)
+
     if not dump_all:
-        # don't use last 10 minutes for safety
-        max_time_max = changesets[-1].max_time - 600
+        # don't use last 10 minutes for safety, of the whole tree including
+        # the revisions after until
+        max_time_max = max(changesets[-1].max_time, cvs.newest) - 600
     else:
         max_time_max = changesets[-1].max_time
 
-    found_last_revision = False
     markseq = cvs.markseq
     extags = set()
-    for k in changesets:
-        if do_incremental and not found_last_revision:
-            if k.min_time == last_ctime and k.author == last_author:
-                found_last_revision = True
-            for tag in k.tags:
+    start = 0
+    if do_incremental:
+        idx = find_changeset(changesets, last_ctime, last_author)
+        if idx < 0:
+            raise Exception('could not find the last revision')
+        # tags on the changesets until the last revision are already there
+        tip = changesets[idx]
+        for tag, c in cvs.tags.items():
+            if c <= tip:
                 extags.add(tag)
-            continue
-        if k.max_time > max_time_max:
+        start = idx + 1
+        # the commits are dumped on top of the tip
+        state_base = git_tip
+        state_start = start
+
+    if verify_file is not None:
+        # verify the changesets until the tip of git
+        ret = git_verify(cvs, rcs, changesets[:start], args[1], git_branch,
+                         verify_file)
+        if content_cache is not None:
+            content_cache.save()
+        sys.exit(ret)
+
+    fingerprint = sha1()
+    if resume is not None:
+        for k in changesets[start:resume['index']]:
+            update_fingerprint(fingerprint, k, cvs.files)
+        if fingerprint.hexdigest() != resume['fingerprint']:
+            print('The checkpoint doesn\'t match the cvs tree.  Remove %s '
+                  'and retry' % (checkpoint_file), file=sys.stderr)
+            sys.exit(1)
+        rewind_output(resume['offset'])
+        markseq = resume['markseq']
+        if resume['index'] > start:
+            git_tip = None
+        start = resume['index']
+    elif checkpoint_file is not None:
+        # the blobs of the walk are in the output
+        save_checkpoint(checkpoint_file, {
+            'index': start, 'markseq': markseq,
+            'fingerprint': fingerprint.hexdigest()})
+
+    last_dumped = None
+    ndumped = 0
+
+    def dump(chg_idx, k, conts):
+        nonlocal markseq, git_tip, last_dumped, ndumped
+        markseq = git_dump_changeset(cvs, k, conts, markseq, git_branch,
+                                     email_domain, git_tip, extags)
+        git_tip = None
+        last_dumped = k
+
+        if checkpoint_file is not None:
+            update_fingerprint(fingerprint, k, cvs.files)
+            ndumped = ndumped + 1
+            if ndumped % checkpoint_interval == 0:
+                save_checkpoint(checkpoint_file, {
+                    'index': chg_idx + 1, 'markseq': markseq,
+                    'fingerprint': fingerprint.hexdigest()})
+
+    end = start
+    while end < nchangesets and changesets[end].max_time <= max_time_max:
+        end = end + 1
+
+    if pack_dir is not None:
+        if end > start:
+            try:
+                if git_pack(cvs, keywords, changesets[start:end], pack_dir,
+                            git_branch, email_domain,
+                            shard_jobs or os.cpu_count() or 1) != 0:
+                    print('Couldn\'t update the refs', file=sys.stderr)
+                    sys.exit(1)
+            except RuntimeError as msg:
+                print('Unexpected runtime error on parsing', msg,
+                      file=sys.stderr)
+                print('unlimit the resource limit may fix this problem.',
+                      file=sys.stderr)
+                sys.exit(1)
+            last_dumped = changesets[end - 1]
+    elif jobs is not None:
+        pipeline = Pipeline(keywords, cvs, jobs)
+        try:
+            pipeline.run(enumerate(changesets[start:end], start), dump)
+        except RuntimeError as msg:
+            print('Unexpected runtime error on parsing', msg,
+                  file=sys.stderr)
+            print('unlimit the resource limit may fix this problem.',
+                  file=sys.stderr)
+            sys.exit(1)
+        pipeline.report()
+    elif shard_jobs is not None:
+        markseq = git_dump_shards(cvs, rcs, changesets[start:end], markseq,
+                                  shard_jobs, git_branch, email_domain,
+                                  git_tip, extags)
+        if end > start:
+            last_dumped = changesets[end - 1]
+    else:
+        # the files which have been read ahead
+        prefetched = set()
+
+        def expand(f):
+            if prefetcher is not None and f.file not in prefetched:
+                prefetched.add(f.file)
+                prefetcher.use(cvs.files[f.file].path)
+            return git_expand(cvs.files[f.file].path, f.rev, rcs)
+
+        if prefetcher is not None and not cvs.dumpfile:
+            # the files are read again in the order of the changesets, each
+            # file is read ahead once before its first use
+            files = dict.fromkeys(f.file for k in changesets[start:end]
+                                  for f in k.revs if cvs.blob(f) is None)
+            prefetcher.start([cvs.files[f].path for f in files])
+        for chg_idx, k in enumerate(changesets[start:end], start):
+            if not cvs.dumpfile:
+                dump(chg_idx, k, (expand(f) if cvs.blob(f) is None else None
+                                  for f in k.revs))
+            else:
+                dump(chg_idx, k, None)
+        if prefetcher is not None and not cvs.dumpfile:
+            prefetcher.stop('dump')
+
+    if content_cache is not None:
+        content_cache.save()
+    if cvs.blobs is not None:
+        print('** %d blobs are reused' % (cvs.blobs.nreused), file=sys.stderr)
+        if export_blobs is not None:
+            cvs.blobs.save(export_blobs)
+    if state_file is not None and do_incremental:
+        if last_dumped is not None:
+            write_state(state_file, state_base, end - state_start,
+                        last_dumped.author, last_dumped.min_time)
+        elif last_revision is None:
+            write_state(state_file, state_base, 0, last_author, last_ctime)
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.unlink(checkpoint_file)
+
+    # flush the compressed output
+    sys.stdout.close()
+    print('** dumped', file=sys.stderr)
+
+
+def parse_time(v):
+    """Parse the time in UTC, "YYYY-MM-DD", "YYYY-MM-DD HH:MM:SS" or the
+    seconds since the epoch."""
+    if v.isdigit():
+        return int(v)
+    for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return calendar.timegm(time.strptime(v, fmt))
+        except ValueError:
+            pass
+    raise ValueError('Invalid time: %s' % (v))
+
+
+def find_changeset(changesets, min_time, author):
+    """Return the index of the changeset which is committed by the author
+    at the time in the sorted changesets, or -1 if it is not found."""
+    lo, hi = 0, len(changesets)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if changesets[mid].min_time < min_time:
+            lo = mid + 1
+        else:
+            hi = mid
+    for i in range(lo, len(changesets)):
+        if changesets[i].min_time != min_time:
             break
+        if changesets[i].author == author:
+            return i
+    # the order is decided by fuzzy comparisons, it might not be sorted by
+    # the time strictly.
+    for i, k in enumerate(changesets):
+        if k.min_time == min_time and k.author == author:
+            return i
+    return -1
 
-        marks = {}
 
-        for f in k.revs:
-            if not do_incremental:
-                marks[f.markseq] = f
-            else:
-                markseq = markseq + 1
-                git_dump_file(f.path, f.rev, rcs, markseq)
-                marks[markseq] = f
-        log = rcsparse.rcsfile(k.revs[0].path).getlog(k.revs[0].rev)
-        for i, e in enumerate(log_encodings):
-            try:
-                how = 'ignore' if i == len(log_encodings) - 1 else 'strict'
-                log = log.decode(e, how)
-                break
-            except UnicodeError:
-                pass
-        log = log.encode('utf-8', 'ignore')
+#
+# The state file keeps the tip of the branch which the dump started from,
+# the number of the dumped commits, and the author and the time of the last
+# one.  It's trusted only when the branch has that many commits on top of
+# the tip, that is the dump has been imported.
+#
+def read_state(path):
+    with open(path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    return lines[0], int(lines[1]), lines[2], float(lines[3])
 
-        output('commit refs/heads/' + git_branch)
-        markseq = markseq + 1
-        output('mark :%d' % (markseq))
-        email = k.author if email_domain is None \
-            else k.author + '@' + email_domain
-        output('author %s <%s> %d +0000' % (k.author, email, k.min_time))
-        output('committer %s <%s> %d +0000' % (k.author, email, k.min_time))
 
-        output('data', len(log))
-        output(log, end='')
-        if do_incremental and git_tip is not None:
-            output('from', git_tip)
-            git_tip = None
+def write_state(path, base, ncommits, author, ctime):
+    # write it to a temporary file first not to break the state file
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('%s\n%d\n%s\n%d\n' % (base, ncommits, author, ctime))
+    os.replace(tmp, path)
 
-        for m in marks:
-            f = marks[m]
-            mode = 0o100755 if os.access(f.path, os.X_OK) else 0o100644
-            fn = file_path(cvs.cvsroot, f.path)
-            if f.state == 'dead':
-                output('D', fn)
-            else:
-                output('M %o :%d %s' % (mode, m, fn))
-        output('')
-        for tag in k.tags:
-            if tag in extags:
-                continue
-            output('reset refs/tags/%s' % (tag))
-            output('from :%d' % (markseq))
-            output('')
 
-    if do_incremental and not found_last_revision:
-        raise Exception('could not find the last revision')
+def check_state(path, git_dir, branch):
+    """Return the tip of the branch, the author and the time of the last
+    imported changeset by the state file, or None if git doesn't have the
+    commits of the state file."""
+    try:
+        base, ncommits, author, ctime = read_state(path)
+    except (OSError, IndexError, ValueError):
+        return None
+    ref = 'refs/heads/' + branch
+    git = subprocess.Popen(
+        ['git', '--git-dir=' + git_dir, 'rev-parse', ref,
+         '%s~%d' % (ref, ncommits)], encoding='utf-8',
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    outs = git.stdout.read().split()
+    git.wait()
+    if git.returncode != 0 or len(outs) != 2 or outs[1] != base:
+        return None
+    return outs[0], author, ctime
+
 
-    print('** dumped', file=sys.stderr)
+#
+# Checkpoints are saved before the walk and at the changeset boundaries.
+# The dump restarted by the same arguments continues from the checkpoint,
+# the output should be appended to the same file.  The checkpoint before the
+# walk has only the offset, the walk is done again from it.
+#
+def update_fingerprint(h, k, files):
+    h.update(('%s %d %d\n' % (k.author, k.min_time, k.max_time))
+             .encode('utf-8'))
+    for f in k.revs:
+        h.update(('%s %s\n' % (files[f.file].path, f.rev)).encode('utf-8'))
+
+
+def load_checkpoint(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, ckpt):
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    out.flush()
+    # the end of the output, which may be opened for appending
+    ckpt['offset'] = out.seek(0, os.SEEK_END) if out.seekable() else None
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(ckpt, f)
+    os.replace(tmp, path)
+
+
+def rewind_output(offset):
+    out = sys.stdout.buffer
+    if offset is None or not out.seekable():
+        print('Warning: the output can\'t be rewound to the checkpoint, '
+              'it may have a partial changeset.', file=sys.stderr)
+        return
+    if os.fstat(out.fileno()).st_size < offset:
+        print('The output is shorter than the checkpoint.  Append the output '
+              'to the previous one', file=sys.stderr)
+        sys.exit(1)
+    out.truncate(offset)
+    out.seek(offset)
 
 
 #
@@ -229,22 +670,93 @@ def main():
 # is UTF-8.  Also write without conversion for a bytes object (file bodies
 # might be various encodings)
 #
-def output(*args, end='\n'):
+def output(*args, end='\n', file=None):
+    out = sys.stdout.buffer if file is None else file.buffer
     if len(args) == 0:
         pass
     elif len(args) > 1 or isinstance(args[0], str):
         lines = ' '.join(
             [arg if isinstance(arg, str) else str(arg) for arg in args])
-        sys.stdout.buffer.write(lines.encode('utf-8'))
+        out.write(lines.encode('utf-8'))
     else:
-        sys.stdout.buffer.write(args[0])
+        out.write(args[0])
     if len(end) > 0:
-        sys.stdout.buffer.write(end.encode('utf-8'))
+        out.write(end.encode('utf-8'))
+
+
+class CompressedOutput(io.RawIOBase):
+    """Compress the output by the threads.  The output is cut into chunks
+    and each chunk is compressed as an independent stream while the
+    conversion continues.  The streams are written in order, the
+    concatenation is a valid gzip, bzip2 or xz file."""
+
+    def __init__(self, out, compress, jobs):
+        super().__init__()
+        self.out = out
+        self.compress = compress
+        self.jobs = jobs
+        self.pool = ThreadPoolExecutor(jobs)
+        self.pending = collections.deque()
+        self.buf = bytearray()
+        self.nchunks = 0
+        self.pid = os.getpid()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if os.getpid() != self.pid:
+            # a forked worker flushes its copy of the stdout
+            return len(b)
+        self.buf += b
+        if len(self.buf) >= COMPRESS_CHUNK:
+            self.submit()
+        return len(b)
+
+    def submit(self):
+        self.pending.append(self.pool.submit(self.compress, bytes(self.buf)))
+        self.buf = bytearray()
+        self.nchunks = self.nchunks + 1
+        # write the compressed chunks, wait if too many are in flight
+        while self.pending and (self.pending[0].done() or
+                                len(self.pending) > self.jobs * 2):
+            self.out.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        if len(self.buf) > 0 or self.nchunks == 0:
+            self.submit()
+        while self.pending:
+            self.out.write(self.pending.popleft().result())
+        self.out.flush()
+        self.pool.shutdown()
+        super().close()
+
+
+def compress_stdout(compression):
+    """Replace the stdout by the one compressed by the compression."""
+    out = CompressedOutput(sys.stdout.buffer, COMPRESSORS[compression],
+                           os.cpu_count() or 1)
+    sys.stdout = io.TextIOWrapper(
+        io.BufferedWriter(out), encoding=sys.stdout.encoding,
+        errors=sys.stdout.errors)
+
+
+class CvsFile:
+    __slots__ = ('path', 'name', 'executable')
+
+    def __init__(self, path, name, executable):
+        self.path = path            # path of the ,v file
+        self.name = name            # path in the output
+        self.executable = executable
 
 
 class FileRevision:
-    def __init__(self, path, rev, state, markseq):
-        self.path = path
+    __slots__ = ('file', 'rev', 'state', 'markseq')
+
+    def __init__(self, file, rev, state, markseq):
+        self.file = file            # index of CvsConv.files
         self.rev = rev
         self.state = state
         self.markseq = markseq
@@ -260,11 +772,14 @@ class ChangeSetKey:
         self.fuzzsec = fuzzsec
         self.revs = []
         self.tags = []
+        self.id = None              # index in CvsConv.csets
         self.log_hash = 0
         h = 0
         for c in log:
             h = 31 * h + c
         self.log_hash = h
+        # the log hash may collide, the logs are stored by the SHA-1
+        self.log_key = sha1(log).digest()
 
     def __lt__(self, other):
         return self._cmp(other) < 0
@@ -321,8 +836,303 @@ class ChangeSetKey:
     def __hash__(self):
         return hash(self.branch + '/' + self.author) * 31 + self.log_hash
 
-    def put_file(self, path, rev, state, markseq):
-        self.revs.append(FileRevision(path, rev, state, markseq))
+    def put_file(self, file, rev, state, markseq):
+        self.revs.append(FileRevision(file, rev, state, markseq))
+
+
+class LogStore:
+    """The logs decoded by the log encodings, keyed by the SHA-1 of the
+    log.  A log which is used by many revisions is decoded and kept only
+    once."""
+    def __init__(self, encodings):
+        self.encodings = encodings
+        self.logs = dict()
+        # the number of the logs decoded by each encoding
+        self.nmatched = [0] * len(encodings)
+
+    def put(self, log_key, log):
+        if log_key in self.logs:
+            return
+        for i, e in enumerate(self.encodings):
+            try:
+                how = 'ignore' if i == len(self.encodings) - 1 else 'strict'
+                log = log.decode(e, how)
+                break
+            except UnicodeError:
+                pass
+        self.nmatched[i] += 1
+        self.logs[log_key] = log.encode('utf-8', 'ignore')
+
+    def get(self, log_key):
+        return self.logs[log_key]
+
+
+class BlobIndex:
+    """The SHA-1s of the dumped blobs by the output path and the revision.
+    It is saved by --export-blobs and loaded by --import-blobs, then the
+    incremental import refers to the blobs which git has already instead of
+    dumping them again.  The blobs are kept when a file is moved to or from
+    the Attic.  A blob which has the ,v path expanded by $Source$ or
+    $Header$ is used only for the same ,v path."""
+
+    def __init__(self, cvsroot):
+        self.cvsroot = cvsroot
+        # (output path, revision) -> (SHA-1, ,v path or None)
+        self.blobs = dict()
+        self.nreused = 0
+
+    @staticmethod
+    def has_path(path, cont):
+        # the expanded keywords are in the bytes chunks, the memoryviews
+        # are the parts of the checked out content as it is
+        p = os.fsencode(path)
+        return any(isinstance(c, bytes) and p in c for c in cont)
+
+    def get(self, cf, rev):
+        b = self.blobs.get((cf.name, rev))
+        if b is None or (b[1] is not None and b[1] != cf.path):
+            return None
+        return b[0]
+
+    def put(self, cf, rev, cont):
+        self.add(cf, rev, blob_sha1(cont), self.has_path(cf.path, cont))
+
+    def add(self, cf, rev, blob, has_path):
+        self.blobs[(cf.name, rev)] = (blob, cf.path if has_path else None)
+
+    def load(self, path):
+        # [SHA-1, revision, output path, ,v path relative to the cvsroot or
+        # null] for each blob
+        with open(path, encoding='utf-8') as f:
+            for blob, rev, name, p in json.load(f)['blobs']:
+                self.blobs[(name, rev)] = (
+                    blob, None if p is None else self.cvsroot + os.sep + p)
+
+    def verify(self, git_dir):
+        """Drop the blobs which git doesn't have, the dump which saved them
+        may not have been imported.  Return the number of them."""
+        shas = {b for b, _ in self.blobs.values()}
+        git = subprocess.run(
+            ['git', '--git-dir=' + git_dir, 'cat-file', '--batch-check'],
+            input=''.join(sha + '\n' for sha in shas), encoding='ascii',
+            stdout=subprocess.PIPE)
+        if git.returncode != 0:
+            raise OSError('git cat-file failed')
+        missing = {line.split()[0] for line in git.stdout.splitlines()
+                   if line.endswith(' missing')}
+        if len(missing) == 0:
+            return 0
+        n = len(self.blobs)
+        self.blobs = {k: b for k, b in self.blobs.items()
+                      if b[0] not in missing}
+        return n - len(self.blobs)
+
+    def save(self, path):
+        n = len(self.cvsroot) + 1
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'blobs': [
+                [blob, rev, name, None if p is None else p[n:]]
+                for (name, rev), (blob, p) in self.blobs.items()]}, f)
+        os.replace(tmp, path)
+
+
+class ContentCache:
+    """The expanded contents of the revisions kept over the conversions.
+    The key is the SHA-1 of the ,v path, the revision, the size and the
+    mtime of the ,v file and the keywords.  The records, the key, the
+    length and the compressed content, are appended to the data file by
+    single writes, so the workers which open the cache add them too.  The
+    index keeps the offsets of the records and the data file is scanned
+    from the end of the indexed records when it's loaded and saved.  When
+    the data file exceeds the size, the least recently used records are
+    dropped."""
+    RECORD = struct.Struct('>20sI')
+    HEADER = struct.Struct('>4sQI')
+    ENTRY = struct.Struct('>20sQII')
+
+    def __init__(self, path, rcs, size):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.size = size
+        self.kwhash = sha1(repr(sorted(rcs.rcs_expkw.items())).encode(
+            'ascii')).digest()
+        self.index = dict()         # key -> (offset, length, generation)
+        self.gen = 0
+        self.scanned = 0
+        self.stats = dict()
+        self.fd = os.open(os.path.join(path, 'data'),
+                          os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.load()
+
+    def load(self):
+        try:
+            with open(os.path.join(self.path, 'index'), 'rb') as f:
+                magic, self.scanned, self.gen = self.HEADER.unpack(
+                    f.read(self.HEADER.size))
+                if magic != b'cvsc':
+                    raise ValueError
+                data = f.read()
+            for key, off, length, gen in self.ENTRY.iter_unpack(data):
+                self.index[key] = (off, length, gen)
+        except (OSError, ValueError, struct.error):
+            self.index = dict()
+            self.scanned = 0
+        self.gen = self.gen + 1
+        self.scan()
+
+    def scan(self):
+        # index the records appended after the last scan
+        end = os.fstat(self.fd).st_size
+        while self.scanned + self.RECORD.size <= end:
+            key, length = self.RECORD.unpack(
+                os.pread(self.fd, self.RECORD.size, self.scanned))
+            off = self.scanned + self.RECORD.size
+            if off + length > end:
+                break
+            self.index[key] = (off, length, self.gen)
+            self.scanned = off + length
+        return end
+
+    def key(self, path, rev):
+        fp = self.stats.get(path)
+        if fp is None:
+            st = os.stat(path)
+            fp = self.stats[path] = b'%d\0%d' % (st.st_size, st.st_mtime_ns)
+        return sha1(os.fsencode(path) + b'\0' + rev.encode('ascii') +
+                    b'\0' + fp + self.kwhash).digest()
+
+    def get(self, path, rev):
+        key = self.key(path, rev)
+        e = self.index.get(key)
+        if e is None:
+            return None
+        data = os.pread(self.fd, self.RECORD.size + e[1],
+                        e[0] - self.RECORD.size)
+        # the record may be replaced by the compaction
+        if len(data) != self.RECORD.size + e[1] or \
+                self.RECORD.unpack_from(data)[0] != key:
+            return None
+        self.index[key] = (e[0], e[1], self.gen)
+        return zlib.decompress(data[self.RECORD.size:])
+
+    def put(self, path, rev, chunks):
+        # the chunks are compressed in turn without joining them
+        z = zlib.compressobj(1)
+        data = b''.join([z.compress(c) for c in chunks] + [z.flush()])
+        os.write(self.fd, self.RECORD.pack(self.key(path, rev), len(data)) +
+                 data)
+
+    def save(self):
+        nindexed = len(self.index)
+        end = self.scan()
+        if self.scanned < end:
+            # drop the broken record at the end
+            os.ftruncate(self.fd, self.scanned)
+        print('** %d contents are in the cache, %d are added' % (
+            len(self.index), len(self.index) - nindexed), file=sys.stderr)
+        if self.scanned > self.size:
+            self.evict()
+        tmp = os.path.join(self.path, 'index.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(b'cvsc', self.scanned, self.gen))
+            for key, (off, length, gen) in self.index.items():
+                f.write(self.ENTRY.pack(key, off, length, gen))
+        os.replace(tmp, os.path.join(self.path, 'index'))
+
+    def evict(self):
+        # keep the recently used records up to the half of the size
+        keys = sorted(self.index, key=lambda k: self.index[k][2],
+                      reverse=True)
+        index = dict()
+        total = 0
+        tmp = os.path.join(self.path, 'data.tmp')
+        with open(tmp, 'wb') as f:
+            for key in keys:
+                off, length, gen = self.index[key]
+                if total + self.RECORD.size + length > self.size // 2:
+                    break
+                f.write(os.pread(self.fd, self.RECORD.size + length,
+                                 off - self.RECORD.size))
+                index[key] = (total + self.RECORD.size, length, gen)
+                total = total + self.RECORD.size + length
+        os.replace(tmp, os.path.join(self.path, 'data'))
+        os.close(self.fd)
+        self.fd = os.open(os.path.join(self.path, 'data'),
+                          os.O_RDWR | os.O_APPEND)
+        print('** %d contents are evicted from the cache' % (
+            len(self.index) - len(index)), file=sys.stderr)
+        self.index = index
+        self.scanned = total
+
+
+class Snapshot:
+    """The metadata of the revisions accepted by the walk.  It's saved by
+    -S, then -A runs the clustering again from it without parsing the ,v
+    files."""
+
+    def __init__(self, cvsroot):
+        self.cvsroot = cvsroot
+        self.files = []
+        self.revs = []
+        self.logs = dict()          # log -> index
+
+    def add_file(self, cf):
+        self.files.append([cf.path, cf.name, cf.executable])
+
+    def add_revision(self, fileidx, rev, state, branch, author, ctime,
+                     commitid, log, tags):
+        logidx = self.logs.setdefault(log, len(self.logs))
+        self.revs.append([fileidx, rev, state, branch, author, ctime,
+                          commitid, logidx, tags])
+
+    def save(self, path):
+        # the logs are kept as they are by latin-1
+        tmp = path + '.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            json.dump({'cvsroot': self.cvsroot, 'files': self.files,
+                       'revs': self.revs,
+                       'logs': [log.decode('latin-1') for log in self.logs]},
+                      f, separators=(',', ':'))
+        os.replace(tmp, path)
+
+
+def analyze(cvs, changesets):
+    nrevs = sum(len(k.revs) for k in changesets)
+    print('changesets: %d' % (len(changesets)))
+    print('revisions: %d' % (nrevs))
+    print('merged by commitid: %d' % (cvs.ncidmerged))
+    print('merged by fuzzy matching: %d' % (cvs.nmerged))
+    print('changeset size (revisions):')
+    hist = dict()
+    for k in changesets:
+        b = len(k.revs).bit_length() - 1
+        hist[b] = hist.get(b, 0) + 1
+    for b in sorted(hist):
+        lo, hi = 1 << b, (1 << (b + 1)) - 1
+        size = '%d' % (lo) if lo == hi else '%d-%d' % (lo, hi)
+        print('  %9s %d' % (size, hist[b]))
+    print('tags: %d' % (len(cvs.tags)))
+    for k in changesets:
+        for tag in k.tags:
+            print('  %-24s %s %s %d' % (
+                tag, time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.gmtime(k.min_time)),
+                k.author, len(k.revs)))
+
+
+# the kinds of the revisions on the trunk and on the vendor branch
+REV_INITIAL = 0             # 1.1
+REV_TRUNK = 1               # 1.x
+REV_OTHER = 2               # 2.x and later
+REV_INITIAL_VENDOR = 3      # 1.1.1.1
+REV_VENDOR = 4              # 1.1.1.x
+
+
+# the same revision numbers appear in many files and symbols
+@functools.lru_cache(maxsize=None)
+def rev_tuple(rev):
+    return tuple(map(int, rev.split('.')))
 
 
 def _cmp2(a, b):
@@ -332,14 +1142,42 @@ def _cmp2(a, b):
 
 
 class CvsConv:
-    def __init__(self, cvsroot, rcs, dumpfile, fuzzsec):
+    def __init__(self, cvsroot, rcs, dumpfile, fuzzsec, log_encodings):
         self.cvsroot = cvsroot
         self.rcs = rcs
         self.changesets = dict()
+        self.logs = LogStore(log_encodings)
+        # the output path and the mode are decided once for each ,v file
+        self.files = []
         self.dumpfile = dumpfile
+        self.dumpblob = True
         self.markseq = 0
+        self.blobs = None
         self.tags = dict()
+        # tag -> (changeset id, time of the tagged revision)
+        self.tagindex = dict()
+        # the changesets by the id, a changeset merged into another keeps
+        # the id of that in csparent
+        self.csets = []
+        self.csparent = []
+        # (commitid, branch, author, hash of the log) -> changeset id
+        self.commitids = dict()
+        self.ncidmerged = 0         # merged by the commitid index
+        self.nmerged = 0            # merged by the fuzzy matching
+        self.snapshot = None
         self.fuzzsec = fuzzsec
+        # the revisions before the horizon are counted but not kept
+        self.horizon = None
+        self.nold = 0
+        # the revisions out of [since, until] aren't kept, the last ones
+        # before since are the baseline
+        self.since = None
+        self.until = None
+        self.baseline = []
+        self.droptags = set()
+        # the time of the newest revision after until
+        self.newest = 0
+        self.prefetcher = None
 
     def walk(self, module=None):
         p = [self.cvsroot]
@@ -347,6 +1185,7 @@ class CvsConv:
             p.append(module)
         path = os.path.join(*p)
 
+        paths = []
         for root, dirs, files in os.walk(path):
             if '.git' in dirs:
                 print('Ignore %s: cannot handle the path named \'.git\'' % (
@@ -359,90 +1198,366 @@ class CvsConv:
             for f in files:
                 if not f[-2:] == ',v':
                     continue
-                self.parse_file(root + os.sep + f)
-
-        for t, c in list(self.tags.items()):
+                paths.append(root + os.sep + f)
+
+        if self.prefetcher is not None:
+            self.prefetcher.start(paths)
+        for path in paths:
+            if self.prefetcher is not None:
+                self.prefetcher.use(path)
+            self.parse_file(path)
+        if self.prefetcher is not None:
+            self.prefetcher.stop('walk')
+
+        self.resolve_tags()
+
+    def walk_modules(self, modules, jobs, keywords):
+        """Walk the modules by the worker processes, then add the revisions
+        in the order of the modules as if they are walked one by one.  The
+        workers also expand the blobs to dump into the temporary files."""
+        if len(modules) == 1 or jobs == 1:
+            for module in modules:
+                self.walk(module)
+            return
+        dumpblob = self.dumpfile and self.dumpblob
+        initargs = pipeline_initargs(keywords, self.rcs)
+        with tempfile.TemporaryDirectory(prefix='cvs2gitdump') as tmpdir, \
+                ProcessPoolExecutor(min(jobs, len(modules)),
+                                    initializer=pipeline_init,
+                                    initargs=initargs) as pool:
+            futs = []
+            for i, module in enumerate(modules):
+                path = os.path.join(tmpdir, 'module%d' % (i)) \
+                    if dumpblob else None
+                futs.append((path, pool.submit(
+                    walk_module, self.cvsroot, module, self.fuzzsec,
+                    self.horizon, self.since, self.until, path)))
+            for path, fut in futs:
+                try:
+                    walked = fut.result()
+                except RuntimeError as msg:
+                    print('Unexpected runtime error on parsing', msg,
+                          file=sys.stderr)
+                    sys.exit(1)
+                if path is None:
+                    self.add_walk(*walked)
+                    continue
+                with open(path, 'rb') as data:
+                    self.add_walk(*walked, data=data)
+                os.unlink(path)
+        self.resolve_tags()
+
+    def add_walk(self, files, revs, logs, baseline, nold, droptags,
+                 newest, dumped=None, data=None):
+        """Add the revisions walked by walk_module(), the blobs are dumped
+        in the same order as parse_file().  The blobs expanded by the
+        worker are copied from data."""
+        base = len(self.files)
+        for path, name, executable in files:
+            self.files.append(CvsFile(path, name, executable))
+        baseline = {f: (rev, state) for f, rev, state in baseline}
+        i = 0
+        j = 0
+        for f in range(len(files)):
+            while i < len(revs) and revs[i][0] == f:
+                _, rev, state, branch, author, ctime, commitid, log, \
+                    tags = revs[i]
+                i = i + 1
+                if self.dumpfile:
+                    self.markseq = self.markseq + 1
+                    if data is not None:
+                        self.copy_blob(base + f, rev, dumped[j], data)
+                        j = j + 1
+                    elif self.dumpblob:
+                        git_dump_file(self.files[base + f], rev, self.rcs,
+                                      self.markseq, self.blobs)
+                self.add_revision(base + f, rev, state, branch, author, ctime,
+                                  commitid, logs[log], tags)
+            if f in baseline:
+                rev, state = baseline[f]
+                if self.dumpfile:
+                    self.markseq = self.markseq + 1
+                    if data is not None:
+                        self.copy_blob(base + f, rev, dumped[j], data)
+                        j = j + 1
+                    elif self.dumpblob:
+                        git_dump_file(self.files[base + f], rev, self.rcs,
+                                      self.markseq, self.blobs)
+                self.baseline.append(FileRevision(base + f, rev, state,
+                                                  self.markseq))
+        self.nold = self.nold + nold
+        self.droptags.update(droptags)
+        self.newest = max(self.newest, newest)
+
+    def copy_blob(self, fileidx, rev, dumped, data):
+        # the data of the blob is written by module_blobs()
+        blob, has_path, size = dumped
+        output('blob')
+        output('mark :%d' % self.markseq)
+        output(data.read(size), end='')
+        if self.blobs is not None:
+            self.blobs.add(self.files[fileidx], rev, blob, has_path)
+
+    def load_snapshot(self, path, modules):
+        """Add the revisions from the snapshot instead of walking the tree.
+        The files out of the modules are skipped."""
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snap = json.load(f)
+        prefixes = tuple(os.path.join(snap['cvsroot'], m) + os.sep
+                         for m in modules)
+        logs = [log.encode('latin-1') for log in snap['logs']]
+        fileidx = dict()
+        for i, (fpath, name, executable) in enumerate(snap['files']):
+            if len(prefixes) > 0 and not fpath.startswith(prefixes):
+                continue
+            fileidx[i] = len(self.files)
+            self.files.append(CvsFile(fpath, name, executable))
+        for f, rev, state, branch, author, ctime, commitid, log, tags \
+                in snap['revs']:
+            if f in fileidx:
+                self.add_revision(fileidx[f], rev, state, branch, author,
+                                  ctime, commitid, logs[log], tags)
+        self.resolve_tags()
+
+    def resolve_tags(self):
+        # the tags point the changesets which they are merged into
+        for c in self.changesets:
+            del c.tags[:]
+        self.tags = dict()
+        for t in self.droptags:
+            self.tagindex.pop(t, None)
+        for t, (i, _) in self.tagindex.items():
+            c = self.changeset(i)
             c.tags.append(t)
+            self.tags[t] = c
+
+    def blob(self, f):
+        # the SHA-1 of the blob which git has already, or None
+        if self.blobs is None:
+            return None
+        return self.blobs.get(self.files[f.file], f.rev)
+
+    def changeset(self, i):
+        parent = self.csparent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return self.csets[root]
 
     def parse_file(self, path):
         rtags = dict()
-        rcsfile = rcsparse.rcsfile(path)
-        branches = {'1': 'HEAD', '1.1.1': 'VENDOR'}
-        for k, v in list(rcsfile.symbols.items()):
-            r = v.split('.')
+        try:
+            rcsfile = RcsHeader(path)
+        except (ValueError, KeyError, IndexError):
+            # let rcsparse parse the unexpected file
+            rcsfile = rcsparse.rcsfile(path)
+        fileidx = len(self.files)
+        self.files.append(CvsFile(
+            path, file_path(self.cvsroot, path),
+            os.access(path, os.X_OK)))
+        if self.snapshot is not None:
+            self.snapshot.add_file(self.files[fileidx])
+        # the revision numbers are parsed once into the tuples of int
+        branches = {(1,): 'HEAD', (1, 1, 1): 'VENDOR'}
+        for k, v in rcsfile.symbols.items():
+            try:
+                r = rev_tuple(v)
+            except ValueError:
+                continue
             if len(r) == 3:
-                branches[v] = 'VENDOR'
-            elif len(r) >= 3 and r[-2] == '0':
-                branches['.'.join(r[:-2] + r[-1:])] = k
-            if len(r) == 2 and branches[r[0]] == 'HEAD':
+                branches[r] = 'VENDOR'
+            elif len(r) >= 3 and r[-2] == 0:
+                branches[r[:-2] + r[-1:]] = k
+            elif len(r) == 2 and r[0] == 1:
                 if v not in rtags:
                     rtags[v] = list()
                 rtags[v].append(k)
 
-        revs = rcsfile.revs.items()
-        # sort by revision descending to priorize 1.1.1.1 than 1.1
-        revs = sorted(revs, key=lambda a: a[1][0], reverse=True)
-        # sort by time
-        revs = sorted(revs, key=lambda a: a[1][1])
+        # classify the revisions, the revisions on the branches are not
+        # used (trunk only)
+        revs = []
+        for k, v in rcsfile.revs.items():
+            r = rev_tuple(k)
+            if len(r) == 2:
+                kind = REV_INITIAL if r == (1, 1) else \
+                    REV_TRUNK if r[0] == 1 else REV_OTHER
+            elif len(r) == 4 and r[:3] == (1, 1, 1):
+                kind = REV_INITIAL_VENDOR if r[3] == 1 else REV_VENDOR
+            else:
+                continue
+            revs.append((v[1], r, kind, k, v))
+        # sort by time, and by revision descending to priorize 1.1.1.1 than
+        # 1.1
+        revs.sort(key=lambda a: (-a[0], a[1]), reverse=True)
+
         novendor = False
         have_initial_revision = False
         last_vendor_status = None
-        for k, v in revs:
-            r = k.split('.')
-            if len(r) == 4 and r[0] == '1' and r[1] == '1' and r[2] == '1' \
-                    and r[3] == '1':
+        base = None
+        for _, r, kind, k, v in revs:
+            if kind == REV_INITIAL_VENDOR:
                 if have_initial_revision:
                     continue
                 if v[3] == 'dead':
                     continue
                 last_vendor_status = v[3]
                 have_initial_revision = True
-            elif len(r) == 4 and r[0] == '1' and r[1] == '1' and r[2] == '1':
+            elif kind == REV_VENDOR:
                 if novendor:
                     continue
                 last_vendor_status = v[3]
-            elif len(r) == 2:
-                if r[0] == '1' and r[1] == '1':
+            else:
+                if kind == REV_INITIAL:
                     if have_initial_revision:
                         continue
                     if v[3] == 'dead':
                         continue
                     have_initial_revision = True
-                elif r[0] == '1' and r[1] != '1':
+                elif kind == REV_TRUNK:
                     novendor = True
                 if last_vendor_status == 'dead' and v[3] == 'dead':
                     last_vendor_status = None
                     continue
                 last_vendor_status = None
-            else:
-                # trunk only
+
+            if self.until is not None and v[1] > self.until:
+                # the tags on the later revisions are made after until
+                self.droptags.update(rtags.get(k, []))
+                self.newest = max(self.newest, v[1])
+                continue
+            if self.since is not None and v[1] < self.since:
+                base = (k, v[3])
+                continue
+            if self.horizon is not None and v[1] < self.horizon:
+                # the changeset and the tags of the revision are in git
+                # already, the tags on the later revisions are resolved
+                # by them
+                self.nold = self.nold + 1
                 continue
 
             if self.dumpfile:
                 self.markseq = self.markseq + 1
-                git_dump_file(path, k, self.rcs, self.markseq)
+                if self.dumpblob:
+                    git_dump_file(self.files[fileidx], k, self.rcs,
+                                  self.markseq, self.blobs)
 
-            b = '.'.join(r[:-1])
             try:
-                a = ChangeSetKey(
-                    branches[b], v[2], v[1], rcsfile.getlog(v[0]), v[6],
-                    self.fuzzsec)
+                log = rcsfile.getlog(v[0])
+                branch = branches[r[:-1]]
             except Exception as e:
                 print('Aborted at %s %s' % (path, v[0]), file=sys.stderr)
                 raise e
 
-            a.put_file(path, k, v[3], self.markseq)
+            tags = rtags.get(k, [])
+            if self.snapshot is not None:
+                # recorded only, the changesets are made from the snapshot
+                self.snapshot.add_revision(fileidx, k, v[3], branch, v[2],
+                                           v[1], v[6], log, tags)
+                continue
+            self.add_revision(fileidx, k, v[3], branch, v[2], v[1], v[6], log,
+                              tags)
+
+        if base is not None and base[1] != 'dead':
+            # only the last revision before since is checked out
+            if self.dumpfile:
+                self.markseq = self.markseq + 1
+                if self.dumpblob:
+                    git_dump_file(self.files[fileidx], base[0], self.rcs,
+                                  self.markseq, self.blobs)
+            self.baseline.append(FileRevision(fileidx, base[0], base[1],
+                                              self.markseq))
+
+    def add_revision(self, fileidx, rev, state, branch, author, ctime,
+                     commitid, log, tags):
+        """Add the revision of the file to the changesets."""
+        # the revisions which have the same commitid are collected by
+        # the index, the fuzzy matching is only for the old revisions
+        # which don't have the commitid
+        cid = None
+        a = None
+        if commitid is not None:
+            cid = (commitid, branch, author, hash(log))
+            i = self.commitids.get(cid)
+            if i is not None:
+                a = self.changeset(i)
+        if a is not None:
+            a.min_time = min(a.min_time, ctime)
+            a.max_time = max(a.max_time, ctime)
+            a.put_file(fileidx, rev, state, self.markseq)
+            self.ncidmerged = self.ncidmerged + 1
+        else:
+            a = ChangeSetKey(branch, author, ctime, log, commitid,
+                             self.fuzzsec)
+            self.logs.put(a.log_key, log)
+            a.put_file(fileidx, rev, state, self.markseq)
             while a in self.changesets:
                 c = self.changesets[a]
                 del self.changesets[a]
                 c.merge(a)
+                if a.id is not None:
+                    # the revisions are in c now
+                    self.csparent[a.id] = c.id
+                    self.csets[a.id] = None
                 a = c
+                self.nmerged = self.nmerged + 1
+            if a.id is None:
+                a.id = len(self.csets)
+                self.csets.append(a)
+                self.csparent.append(a.id)
             self.changesets[a] = a
-            if k in rtags:
-                for t in rtags[k]:
-                    if t not in self.tags or \
-                            self.tags[t].max_time < a.max_time:
-                        self.tags[t] = a
+            if cid is not None:
+                self.commitids[cid] = a.id
+        for t in tags:
+            if t not in self.tagindex or self.tagindex[t][1] < ctime:
+                self.tagindex[t] = (a.id, ctime)
+
+
+def walk_module(cvsroot, module, fuzzsec, horizon, since, until,
+                blobs_path=None):
+    # the revisions are recorded by the snapshot instead of the changesets
+    cvs = CvsConv(cvsroot, RcsKeywords(), False, fuzzsec, [])
+    cvs.horizon = horizon
+    cvs.since = since
+    cvs.until = until
+    cvs.snapshot = Snapshot(cvsroot)
+    cvs.walk(module)
+    baseline = [(f.file, f.rev, f.state) for f in cvs.baseline]
+    dumped = None
+    if blobs_path is not None:
+        dumped = module_blobs(blobs_path, cvs.snapshot.files,
+                              cvs.snapshot.revs, baseline)
+    return (cvs.snapshot.files, cvs.snapshot.revs, list(cvs.snapshot.logs),
+            baseline, cvs.nold, cvs.droptags, cvs.newest, dumped)
+
+
+def module_blobs(path, files, revs, baseline):
+    """Expand the blobs of the walked revisions in the order of add_walk()
+    and write the data of them to the file.  Return (SHA-1, whether the ,v
+    path is expanded, the size of the data) for each blob."""
+    baseline = {f: rev for f, rev, _ in baseline}
+    dumped = []
+    i = 0
+    with open(path, 'wb') as out:
+        for f, (fpath, _, _) in enumerate(files):
+            frevs = []
+            while i < len(revs) and revs[i][0] == f:
+                frevs.append(revs[i][1])
+                i = i + 1
+            if f in baseline:
+                frevs.append(baseline[f])
+            for rev in frevs:
+                cont = span_chunks(*pipeline_expand(fpath, rev))
+                size = sum(len(c) for c in cont)
+                header = b'data %d\n' % (size)
+                out.write(header)
+                out.writelines(cont)
+                out.write(b'\n')
+                dumped.append((blob_sha1(cont),
+                               BlobIndex.has_path(fpath, cont),
+                               len(header) + size + 1))
+    return dumped
 
 
 def file_path(r, p):
@@ -457,19 +1572,1114 @@ def file_path(r, p):
     return path
 
 
-def git_dump_file(path, k, rcs, markseq):
+def blob_sha1(cont):
+    # the object name of the blob in git
+    h = sha1(b'blob %d\0' % (sum(len(c) for c in cont)))
+    for c in cont:
+        h.update(c)
+    return h.hexdigest()
+
+
+#
+# The verification computes the expected trees from the changesets and
+# compares them with the trees in git by the blob SHA-1s, nothing is checked
+# out by git.  The expected tree of the tip is saved, the next verification
+# continues from it.
+#
+def git_verify(cvs, rcs, changesets, git_dir, branch, path):
+    tree = dict()
+    start = 0
+    fingerprint = sha1()
+    if os.path.exists(path):
+        state = load_checkpoint(path)
+        for k in changesets[:state['index']]:
+            update_fingerprint(fingerprint, k, cvs.files)
+        if state['index'] <= len(changesets) and \
+                fingerprint.hexdigest() == state['fingerprint']:
+            start = state['index']
+            tree = state['tree']
+        else:
+            print('** %s doesn\'t match the cvs tree, verify from the '
+                  'beginning' % (path), file=sys.stderr)
+            fingerprint = sha1()
+    print('** verify %d changesets' % (len(changesets) - start),
+          file=sys.stderr)
+
+    nrefs = 0
+    nerrors = 0
+    for k in changesets[start:]:
+        for f in k.revs:
+            cf = cvs.files[f.file]
+            if f.state == 'dead':
+                tree.pop(cf.name, None)
+                continue
+            blob = cvs.blob(f)
+            if blob is None:
+                blob = blob_sha1(git_expand(cf.path, f.rev, rcs))
+            tree[cf.name] = ['%o' % (0o100755 if cf.executable else 0o100644),
+                             blob]
+        update_fingerprint(fingerprint, k, cvs.files)
+        for tag in k.tags:
+            nrefs = nrefs + 1
+            nerrors = nerrors + git_compare_tree(git_dir, 'refs/tags/' + tag,
+                                                 tree)
+    nrefs = nrefs + 1
+    nerrors = nerrors + git_compare_tree(git_dir, 'refs/heads/' + branch,
+                                         tree)
+    print('** verified %d refs, %d differences' % (nrefs, nerrors),
+          file=sys.stderr)
+    if nerrors > 0:
+        return 1
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'index': len(changesets),
+                   'fingerprint': fingerprint.hexdigest(), 'tree': tree}, f)
+    os.replace(tmp, path)
+    return 0
+
+
+def git_compare_tree(git_dir, ref, tree):
+    """Compare the tree of the ref with the expected tree by streaming
+    git ls-tree, print the differences and return the number of them."""
+    git = subprocess.Popen(
+        ['git', '--git-dir=' + git_dir, 'ls-tree', '-r', '-z', '--full-tree',
+         ref], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    nerrors = 0
+    seen = set()
+    rest = b''
+    for data in iter(lambda: git.stdout.read(65536), b''):
+        entries = (rest + data).split(b'\0')
+        rest = entries.pop()
+        for entry in entries:
+            meta, name = entry.split(b'\t', 1)
+            mode, _, blob = meta.decode('ascii').split(' ')
+            name = name.decode('utf-8', 'surrogateescape')
+            seen.add(name)
+            exp = tree.get(name)
+            if exp is None:
+                print('%s: %s is not in cvs' % (ref, name))
+                nerrors = nerrors + 1
+            elif exp[1] != blob:
+                print('%s: %s differs' % (ref, name))
+                nerrors = nerrors + 1
+            elif exp[0] != mode:
+                print('%s: %s has the mode %s, not %s' % (
+                      ref, name, mode, exp[0]))
+                nerrors = nerrors + 1
+    git.wait()
+    if git.returncode != 0:
+        print('%s: not found' % (ref))
+        return nerrors + 1
+    for name in tree:
+        if name not in seen:
+            print('%s: %s is not in git' % (ref, name))
+            nerrors = nerrors + 1
+    return nerrors
+
+
+def git_dump_changeset(cvs, k, conts, markseq, branch, email_domain, tip,
+                       extags, file=None):
+    """Dump the blobs and the commit of the changeset k and return the last
+    mark.  conts are the contents of the revisions of k, or None if the
+    blobs have been dumped by the walk."""
+    marks = []
+    if conts is None:
+        marks = [(':%d' % (f.markseq), f) for f in k.revs]
+    else:
+        for f, cont in zip(k.revs, conts):
+            blob = cvs.blob(f)
+            if blob is not None:
+                # git has the blob already
+                marks.append((blob, f))
+                cvs.blobs.nreused = cvs.blobs.nreused + 1
+                continue
+            if cont is not None:
+                markseq = markseq + 1
+                git_dump_blob(cont, markseq, file=file)
+                if cvs.blobs is not None:
+                    cvs.blobs.put(cvs.files[f.file], f.rev, cont)
+            marks.append((':%d' % (markseq), f))
+    log = cvs.logs.get(k.log_key)
+
+    output('commit refs/heads/' + branch, file=file)
+    markseq = markseq + 1
+    output('mark :%d' % (markseq), file=file)
+    email = k.author if email_domain is None \
+        else k.author + '@' + email_domain
+    output('author %s <%s> %d +0000' % (k.author, email, k.min_time),
+           file=file)
+    output('committer %s <%s> %d +0000' % (k.author, email, k.min_time),
+           file=file)
+
+    output('data', len(log), file=file)
+    output(log, end='', file=file)
+    if tip is not None:
+        output('from', tip, file=file)
+
+    for m, f in marks:
+        cf = cvs.files[f.file]
+        if f.state == 'dead':
+            output('D', cf.name, file=file)
+        else:
+            mode = 0o100755 if cf.executable else 0o100644
+            output('M %o %s %s' % (mode, m, cf.name), file=file)
+    output('', file=file)
+    for tag in k.tags:
+        if tag in extags:
+            continue
+        output('reset refs/tags/%s' % (tag), file=file)
+        output('from :%d' % (markseq), file=file)
+        output('', file=file)
+    return markseq
+
+
+def git_expand(path, k, rcs):
     try:
-        cont = rcs.expand_keyword(path, k)
+        return rcs.expand_keyword_chunks(path, k)
     except RuntimeError as msg:
         print('Unexpected runtime error on parsing',
               path, k, ':', msg, file=sys.stderr)
         print('unlimit the resource limit may fix this problem.',
               file=sys.stderr)
         sys.exit(1)
-    output('blob')
-    output('mark :%d' % markseq)
-    output('data', len(cont))
-    output(cont)
+
+
+def git_dump_file(cf, k, rcs, markseq, blobs=None):
+    cont = git_expand(cf.path, k, rcs)
+    git_dump_blob(cont, markseq)
+    if blobs is not None:
+        blobs.put(cf, k, cont)
+
+
+def git_dump_blob(cont, markseq, file=None):
+    output('blob', file=file)
+    output('mark :%d' % markseq, file=file)
+    output('data', sum(len(c) for c in cont), file=file)
+    for c in cont:
+        output(c, end='', file=file)
+    output('', file=file)
+
+
+#
+# The dump can be rendered in parallel since the blobs and the commits of a
+# changeset depend only on the changeset once the marks are decided.  The
+# changesets are split into the contiguous ranges, the workers forked from
+# the conversion render them into the shard files with the marks assigned
+# in advance, and the shards are concatenated in order.
+#
+shard_context = None
+
+
+def git_dump_shards(cvs, rcs, changesets, markseq, jobs, branch,
+                    email_domain, tip, extags):
+    global shard_context
+    ranges = split_shards(cvs, changesets, jobs * 4)
+    starts = []
+    for lo, hi in ranges:
+        starts.append(markseq)
+        for k in changesets[lo:hi]:
+            markseq = markseq + changeset_marks(cvs, k)
+
+    # the workers share the conversion by fork
+    shard_context = (cvs, rcs, changesets, branch, email_domain, extags)
+    out = sys.stdout.buffer
+    with tempfile.TemporaryDirectory(prefix='cvs2gitdump') as tmpdir, \
+            ProcessPoolExecutor(
+                jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+        futs = []
+        for i, (lo, hi) in enumerate(ranges):
+            path = os.path.join(tmpdir, 'shard%d' % (i))
+            futs.append((path, pool.submit(
+                git_dump_shard, path, lo, hi, starts[i],
+                tip if i == 0 else None)))
+        for path, fut in futs:
+            blobs, nreused = fut.result()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.unlink(path)
+            if cvs.blobs is not None:
+                cvs.blobs.blobs.update(blobs)
+                cvs.blobs.nreused = cvs.blobs.nreused + nreused
+    out.flush()
+    shard_context = None
+    print('** rendered %d shards by %d processes' % (len(ranges), jobs),
+          file=sys.stderr)
+    return markseq
+
+
+def split_shards(cvs, changesets, nshards):
+    """Split the changesets into the contiguous ranges which have about the
+    same number of the revisions to check out."""
+    weights = [changeset_marks(cvs, k) for k in changesets]
+    total = sum(weights)
+    bounds = [0]
+    acc = 0
+    for i, w in enumerate(weights[:-1]):
+        acc = acc + w
+        if acc * nshards >= total * len(bounds):
+            bounds.append(i + 1)
+    bounds.append(len(changesets))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def changeset_marks(cvs, k):
+    # the number of the marks which git_dump_shard uses for the changeset
+    n = 1
+    for f in k.revs:
+        if f.state != 'dead' and cvs.blob(f) is None:
+            n = n + 1
+    return n
+
+
+def git_dump_shard(path, lo, hi, markseq, tip):
+    cvs, rcs, changesets, branch, email_domain, extags = shard_context
+    nreused = 0 if cvs.blobs is None else cvs.blobs.nreused
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for k in changesets[lo:hi]:
+            conts = (None if r.state == 'dead' or cvs.blob(r) is not None
+                     else git_expand(cvs.files[r.file].path, r.rev, rcs)
+                     for r in k.revs)
+            markseq = git_dump_changeset(cvs, k, conts, markseq, branch,
+                                         email_domain, tip, extags, file=f)
+            tip = None
+    if cvs.blobs is None:
+        return None, 0
+    # return the blobs which are dumped by this shard
+    blobs = {}
+    for k in changesets[lo:hi]:
+        for r in k.revs:
+            key = (cvs.files[r.file].name, r.rev)
+            if r.state != 'dead' and key in cvs.blobs.blobs:
+                blobs[key] = cvs.blobs.blobs[key]
+    return blobs, cvs.blobs.nreused - nreused
+
+
+#
+# The pack is written without git fast-import for the first import.  The
+# revisions of each ,v file are expanded, hashed and compressed in order by
+# the worker processes, and each revision is stored as a delta against the
+# previous revision of the file.  The trees and the commits are made by the
+# conversion, then the index of the pack is written and the refs are
+# updated by git update-ref.
+#
+PACK_COMMIT = 1
+PACK_TREE = 2
+PACK_BLOB = 3
+PACK_OFS_DELTA = 6
+PACK_TYPES = {PACK_COMMIT: b'commit', PACK_TREE: b'tree', PACK_BLOB: b'blob'}
+PACK_DEPTH = 50             # the max length of the delta chains
+PACK_MIN_COPY = 16          # the shorter matches are inserted
+
+
+def git_pack(cvs, keywords, changesets, git_dir, branch, email_domain,
+             jobs):
+    """Write the blobs, the trees and the commits of the changesets into a
+    pack of git_dir, and point the branch and the tags to the commits."""
+    pack = PackWriter(git_dir)
+
+    # the revisions of each file in the order of the changesets
+    revs = dict()
+    for k in changesets:
+        for f in k.revs:
+            if f.state != 'dead':
+                revs.setdefault(f.file, []).append(f.rev)
+
+    blobs = dict()
+    initargs = pipeline_initargs(keywords, cvs.rcs)
+    with ProcessPoolExecutor(jobs, initializer=pipeline_init,
+                             initargs=initargs) as pool:
+        pending = collections.deque()
+
+        def write(n):
+            while len(pending) > n:
+                fileidx, fut = pending.popleft()
+                for rev, sha, size, data, base, has_path in fut.result():
+                    blobs[(fileidx, rev)] = sha
+                    if data is not None:
+                        pack.write(sha, PACK_BLOB, size, data, base)
+                    if cvs.blobs is not None:
+                        cvs.blobs.add(cvs.files[fileidx], rev, sha.hex(),
+                                      has_path)
+
+        for fileidx, rs in revs.items():
+            pending.append((fileidx, pool.submit(
+                pack_file, cvs.files[fileidx].path, rs)))
+            write(jobs * 4)
+        write(0)
+    print('** packed %d blobs' % (len(pack.objects)), file=sys.stderr)
+
+    refs = dict()
+    root = PackTree()
+    commit = None
+    for k in changesets:
+        for f in k.revs:
+            cf = cvs.files[f.file]
+            if f.state == 'dead':
+                root.remove(cf.name)
+            else:
+                root.put(cf.name, b'100755' if cf.executable else b'100644',
+                         blobs[(f.file, f.rev)])
+        email = k.author if email_domain is None \
+            else k.author + '@' + email_domain
+        body = b'tree ' + root.write(pack).hex().encode() + b'\n'
+        if commit is not None:
+            body += b'parent ' + commit.hex().encode() + b'\n'
+        body += ('author %s <%s> %d +0000\ncommitter %s <%s> %d +0000\n\n' % (
+            k.author, email, k.min_time, k.author, email, k.min_time)).encode(
+                'utf-8')
+        commit = pack.add(PACK_COMMIT, body + cvs.logs.get(k.log_key))
+        for tag in k.tags:
+            refs['refs/tags/' + tag] = commit
+    refs['refs/heads/' + branch] = commit
+    pack.close()
+    print('** packed %d objects' % (len(pack.objects)), file=sys.stderr)
+
+    git = subprocess.Popen(['git', '--git-dir=' + git_dir, 'update-ref',
+                            '--stdin'], stdin=subprocess.PIPE,
+                           encoding='utf-8')
+    git.communicate(''.join('update %s %s\n' % (ref, sha.hex())
+                            for ref, sha in refs.items()))
+    return git.returncode
+
+
+def pack_file(path, revs):
+    """Expand the revisions of the ,v file in order, and return (revision,
+    SHA-1, size, the compressed object, the SHA-1 of the delta base,
+    whether the ,v path is expanded) for each.  The object is None if it's
+    the same as the previous one."""
+    objs = []
+    prev = None
+    prevsha = None
+    depth = 0
+    for rev in revs:
+        cont = b''.join(span_chunks(*pipeline_expand(path, rev)))
+        sha = sha1(b'blob %d\0' % (len(cont)))
+        sha.update(cont)
+        sha = sha.digest()
+        has_path = BlobIndex.has_path(path, [cont])
+        if sha == prevsha:
+            objs.append((rev, sha, 0, None, None, has_path))
+            continue
+        lines = cont.splitlines(True)
+        delta = None
+        if prev is not None and depth < PACK_DEPTH:
+            delta = make_delta(prev, lines)
+        if delta is not None and len(delta) < len(cont):
+            objs.append((rev, sha, len(delta), zlib.compress(delta),
+                         prevsha, has_path))
+            depth = depth + 1
+        else:
+            objs.append((rev, sha, len(cont), zlib.compress(cont), None,
+                         has_path))
+            depth = 0
+        prev = lines
+        prevsha = sha
+    return objs
+
+
+def make_delta(base, target):
+    """Return the git delta which makes target from base.  base and target
+    are the lists of the lines of the blobs or the entries of the trees, the
+    runs of the lines of target which are in base are copied and others are
+    inserted."""
+    index = dict()
+    offs = []
+    pos = 0
+    for j, line in enumerate(base):
+        index.setdefault(line, j)
+        offs.append(pos)
+        pos = pos + len(line)
+    data = b''.join(target)
+    out = bytearray(delta_varint(pos) + delta_varint(len(data)))
+    ins = 0                     # the start of the pending insert
+    pos = 0
+    i = 0
+    while i < len(target):
+        j = index.get(target[i])
+        start = pos
+        pos = pos + len(target[i])
+        i = i + 1
+        if j is None:
+            continue
+        off = offs[j]
+        j = j + 1
+        while i < len(target) and j < len(base) and base[j] == target[i]:
+            pos = pos + len(target[i])
+            i = i + 1
+            j = j + 1
+        if pos - start < PACK_MIN_COPY:
+            continue
+        delta_insert(out, data, ins, start)
+        delta_copy(out, off, pos - start)
+        ins = pos
+    delta_insert(out, data, ins, len(data))
+    return bytes(out)
+
+
+def delta_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(0x80 | (n & 0x7f))
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def delta_insert(out, data, lo, hi):
+    while lo < hi:
+        n = min(hi - lo, 0x7f)
+        out.append(n)
+        out += data[lo:lo + n]
+        lo = lo + n
+
+
+def delta_copy(out, off, n):
+    while n > 0:
+        size = min(n, 0x10000)
+        op = 0x80
+        args = bytearray()
+        for i in range(4):
+            if (off >> (8 * i)) & 0xff:
+                op |= 1 << i
+                args.append((off >> (8 * i)) & 0xff)
+        # the size 0x10000 is encoded as 0
+        for i in range(3):
+            if (size & 0xffff) >> (8 * i) & 0xff:
+                op |= 0x10 << i
+                args.append((size >> (8 * i)) & 0xff)
+        out.append(op)
+        out += args
+        off = off + size
+        n = n - size
+
+
+class PackTree:
+    """A directory of the tree of the branch.  The SHA-1 is kept until an
+    entry under the directory is changed, the empty directories are
+    removed.  The new tree is written as a delta against the previous
+    one."""
+    __slots__ = ('entries', 'sha', 'base', 'units', 'depth')
+
+    def __init__(self):
+        self.entries = dict()       # name -> PackTree or (mode, SHA-1)
+        self.sha = None
+        self.base = None            # the SHA-1 of the previous tree
+        self.units = None           # the entries of the previous tree
+        self.depth = 0
+
+    def put(self, path, mode, sha):
+        names = path.split('/')
+        t = self
+        t.sha = None
+        for name in names[:-1]:
+            if not isinstance(t.entries.get(name), PackTree):
+                t.entries[name] = PackTree()
+            t = t.entries[name]
+            t.sha = None
+        t.entries[names[-1]] = (mode, sha)
+
+    def remove(self, path):
+        names = path.split('/')
+        trees = [self]
+        for name in names[:-1]:
+            t = trees[-1].entries.get(name)
+            if not isinstance(t, PackTree):
+                return
+            trees.append(t)
+        if trees[-1].entries.pop(names[-1], None) is None:
+            return
+        for t in trees:
+            t.sha = None
+        for i in range(len(trees) - 1, 0, -1):
+            if len(trees[i].entries) == 0:
+                del trees[i - 1].entries[names[i - 1]]
+
+    def write(self, pack):
+        """Write the changed directories into the pack and return the SHA-1
+        of the tree."""
+        if self.sha is not None:
+            return self.sha
+        ents = []
+        for name, e in self.entries.items():
+            name = name.encode('utf-8')
+            if isinstance(e, PackTree):
+                # the directories are sorted as if they end with '/'
+                ents.append((name + b'/', b'40000', name, e.write(pack)))
+            else:
+                ents.append((name, e[0], name, e[1]))
+        ents.sort()
+        units = [mode + b' ' + name + b'\0' + sha
+                 for _, mode, name, sha in ents]
+        delta = None
+        if self.units is not None and self.depth < PACK_DEPTH:
+            delta = make_delta(self.units, units)
+        body = b''.join(units)
+        if delta is not None and len(delta) < len(body):
+            self.sha = pack.add(PACK_TREE, body, delta, self.base)
+            self.depth = self.depth + 1
+        else:
+            self.sha = pack.add(PACK_TREE, body)
+            self.depth = 0
+        self.base = self.sha
+        self.units = units
+        return self.sha
+
+
+class PackWriter:
+    """Write the objects into a pack in the objects/pack directory of
+    git_dir and write the index of it when it's closed."""
+
+    def __init__(self, git_dir):
+        self.dir = os.path.join(git_dir, 'objects', 'pack')
+        fd, self.tmp = tempfile.mkstemp(prefix='tmp_pack_', dir=self.dir)
+        self.f = os.fdopen(fd, 'wb')
+        # the number of the objects is written when it's closed
+        self.f.write(b'PACK' + struct.pack('>II', 2, 0))
+        self.offset = 12
+        self.objects = dict()       # SHA-1 -> (offset, crc32)
+
+    def write(self, sha, kind, size, data, base=None):
+        """Write the object compressed into data unless the pack has it.
+        base is the SHA-1 of the delta base of data."""
+        if sha in self.objects:
+            return
+        hdr = bytearray()
+        c = ((kind if base is None else PACK_OFS_DELTA) << 4) | (size & 0x0f)
+        size >>= 4
+        while size > 0:
+            hdr.append(0x80 | c)
+            c = size & 0x7f
+            size >>= 7
+        hdr.append(c)
+        if base is not None:
+            n = self.offset - self.objects[base][0]
+            ofs = bytearray([n & 0x7f])
+            n >>= 7
+            while n > 0:
+                n = n - 1
+                ofs.insert(0, 0x80 | (n & 0x7f))
+                n >>= 7
+            hdr += ofs
+        self.f.write(hdr)
+        self.f.write(data)
+        self.objects[sha] = (self.offset, zlib.crc32(data, zlib.crc32(hdr)))
+        self.offset = self.offset + len(hdr) + len(data)
+
+    def add(self, kind, body, delta=None, base=None):
+        """Write the object, or the delta of it against base, and return its
+        SHA-1."""
+        sha = sha1(b'%s %d\0' % (PACK_TYPES[kind], len(body)))
+        sha.update(body)
+        sha = sha.digest()
+        if sha not in self.objects and delta is not None:
+            self.write(sha, kind, len(delta), zlib.compress(delta), base)
+        elif sha not in self.objects:
+            self.write(sha, kind, len(body), zlib.compress(body))
+        return sha
+
+    def close(self):
+        self.f.seek(8)
+        self.f.write(struct.pack('>I', len(self.objects)))
+        self.f.close()
+        h = sha1()
+        with open(self.tmp, 'rb') as f:
+            for data in iter(lambda: f.read(1048576), b''):
+                h.update(data)
+        packsha = h.digest()
+        with open(self.tmp, 'ab') as f:
+            f.write(packsha)
+
+        # the index version 2
+        shas = sorted(self.objects)
+        fanout = [0] * 256
+        for sha in shas:
+            fanout[sha[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        offsets = []
+        large = []
+        for sha in shas:
+            off = self.objects[sha][0]
+            if off >= 0x80000000:
+                offsets.append(0x80000000 | len(large))
+                large.append(off)
+            else:
+                offsets.append(off)
+        idx = b'\377tOc' + struct.pack('>I', 2) + \
+            struct.pack('>256I', *fanout) + b''.join(shas) + \
+            struct.pack('>%dI' % (len(shas)),
+                        *(self.objects[sha][1] for sha in shas)) + \
+            struct.pack('>%dI' % (len(offsets)), *offsets) + \
+            struct.pack('>%dQ' % (len(large)), *large) + packsha
+        idx += sha1(idx).digest()
+
+        name = os.path.join(self.dir, 'pack-' + packsha.hex())
+        with open(name + '.idx.tmp', 'wb') as f:
+            f.write(idx)
+        os.chmod(self.tmp, 0o444)
+        os.chmod(name + '.idx.tmp', 0o444)
+        # git finds the pack by the index
+        os.replace(self.tmp, name + '.pack')
+        os.replace(name + '.idx.tmp', name + '.idx')
+
+
+#
+# The pipeline overlaps the reads of the ,v files, the check outs and the
+# writes to the importer.  The stages are connected by bounded queues, a
+# stage waits when the next queue is full, so the earlier stages don't run
+# ahead of the writer more than the queue sizes.
+#
+class PipelineQueue:
+    """A bounded queue between the stages which records its depth and the
+    time the stages waited for it."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = asyncio.Queue(maxsize)
+        self.nput = 0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.full_wait = 0.0        # the producer waited for the consumer
+        self.empty_wait = 0.0       # the consumer waited for the producer
+
+    async def put(self, item):
+        t = time.time()
+        await self.queue.put(item)
+        self.full_wait += time.time() - t
+        depth = self.queue.qsize()
+        self.nput = self.nput + 1
+        self.depth_sum = self.depth_sum + depth
+        self.depth_max = max(self.depth_max, depth)
+
+    async def get(self):
+        t = time.time()
+        item = await self.queue.get()
+        self.empty_wait += time.time() - t
+        return item
+
+    def report(self):
+        print('** %s queue: depth avg %.1f max %d, waited %.1fs full, '
+              '%.1fs empty' % (
+                  self.name, self.depth_sum / self.nput if self.nput else 0,
+                  self.depth_max, self.full_wait, self.empty_wait),
+              file=sys.stderr)
+
+
+class Pipeline:
+    """Dump the changesets by the read-ahead of the ,v files, the check outs
+    and the expansions by the worker processes and the writer.  The
+    contents which are expanded but not written yet are kept within the
+    budget of the bytes."""
+
+    def __init__(self, keywords, cvs, jobs, depth=PIPELINE_DEPTH,
+                 budget=PIPELINE_BYTES):
+        self.keywords = keywords
+        self.cvs = cvs
+        self.jobs = jobs
+        self.depth = depth
+        self.budget = budget
+        self.readq = None
+        self.expandq = None
+        self.write_time = 0.0
+        self.nrunning = 0           # the expansions not done yet
+        self.inflight = 0           # the bytes expanded but not written
+        self.inflight_max = 0
+        self.space = None
+
+    def run(self, changesets, dump):
+        """Dump (chg_idx, k) of changesets in order by dump(chg_idx, k,
+        conts).  dump is called in the writer thread."""
+        asyncio.run(self.main(changesets, dump))
+
+    async def main(self, changesets, dump):
+        self.readq = PipelineQueue('read', self.depth)
+        self.expandq = PipelineQueue('expand', self.depth)
+        self.space = asyncio.Event()
+        initargs = pipeline_initargs(self.keywords, self.cvs.rcs)
+        with ThreadPoolExecutor(1) as reader, \
+                ProcessPoolExecutor(self.jobs, initializer=pipeline_init,
+                                    initargs=initargs) as expander, \
+                ThreadPoolExecutor(1) as writer:
+            await asyncio.gather(
+                self.read(reader, changesets),
+                self.expand(expander),
+                self.write(writer, dump))
+
+    async def read(self, pool, changesets):
+        loop = asyncio.get_running_loop()
+        for chg_idx, k in changesets:
+            paths = {self.cvs.files[f.file].path for f in k.revs
+                     if f.state != 'dead' and self.cvs.blob(f) is None}
+            await loop.run_in_executor(pool, read_ahead, paths)
+            await self.readq.put((chg_idx, k))
+        await self.readq.put(None)
+
+    async def expand(self, pool):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.readq.get()
+            if item is None:
+                break
+            chg_idx, k = item
+            # the writer takes the contents as they are expanded, a large
+            # changeset isn't kept at once
+            futs = queue.SimpleQueue()
+            await self.expandq.put((chg_idx, k, futs))
+            for f in k.revs:
+                # the dead revisions and the blobs which git has already
+                # don't need the contents
+                if f.state == 'dead' or self.cvs.blob(f) is not None:
+                    futs.put(None)
+                    continue
+                while self.nrunning >= 2 * self.jobs or \
+                        self.inflight >= self.budget:
+                    self.space.clear()
+                    await self.space.wait()
+                self.nrunning = self.nrunning + 1
+                fut = pool.submit(pipeline_expand,
+                                  self.cvs.files[f.file].path, f.rev)
+                fut.add_done_callback(
+                    lambda fut: loop.call_soon_threadsafe(self.expanded, fut))
+                futs.put(fut)
+        await self.expandq.put(None)
+
+    def expanded(self, fut):
+        self.nrunning = self.nrunning - 1
+        if not fut.cancelled() and fut.exception() is None:
+            self.inflight = self.inflight + spans_size(*fut.result())
+            self.inflight_max = max(self.inflight_max, self.inflight)
+        self.space.set()
+
+    def written(self, size):
+        self.inflight = self.inflight - size
+        self.space.set()
+
+    def contents(self, loop, k, futs):
+        # the contents of k in the writer thread, the bytes are released
+        # when the next one is taken
+        for _ in k.revs:
+            fut = futs.get()
+            if fut is None:
+                yield None
+                continue
+            cont, spans = fut.result()
+            try:
+                yield span_chunks(cont, spans)
+            finally:
+                loop.call_soon_threadsafe(self.written,
+                                          spans_size(cont, spans))
+
+    async def write(self, pool, dump):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.expandq.get()
+            if item is None:
+                break
+            chg_idx, k, futs = item
+            conts = self.contents(loop, k, futs)
+            t = time.time()
+            try:
+                await loop.run_in_executor(pool, dump, chg_idx, k, conts)
+            finally:
+                conts.close()
+            self.write_time += time.time() - t
+
+    def report(self):
+        self.readq.report()
+        self.expandq.report()
+        print('** writer: %.1fs in writing, %.1fMB expanded at most' % (
+            self.write_time, self.inflight_max / 1048576.0),
+            file=sys.stderr)
+
+
+def read_ahead(paths):
+    # read the ,v files into the page cache for the check outs
+    for path in paths:
+        prefetch_file(path)
+
+
+def prefetch_file(path):
+    # the kernel starts reading the whole file, reading it through makes
+    # sure it's cached also where the advice is ignored like on NFS
+    buf = bytearray(1024 * 1024)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while f.readinto(buf):
+            pass
+
+
+class Prefetcher:
+    """Read the ,v files into the page cache ahead of the parser.  The
+    paths are given in the order they are used and use() is called before
+    each of them is read.  The bytes read ahead but not used yet are kept
+    within the budget."""
+
+    def __init__(self, budget, jobs=PREFETCH_JOBS):
+        self.budget = budget
+        self.jobs = jobs
+        self.cond = threading.Condition()
+        self.pending = collections.deque()  # (index, size, future)
+        self.inflight = 0
+        self.nused = 0
+        self.nwarm = 0
+        self.stopped = False
+        self.pool = None
+        self.feeder = None
+
+    def start(self, paths):
+        self.pending.clear()
+        self.inflight = 0
+        self.nused = 0
+        self.nwarm = 0
+        self.stopped = False
+        self.pool = ThreadPoolExecutor(self.jobs)
+        self.feeder = threading.Thread(target=self.feed, args=(paths,),
+                                       daemon=True)
+        self.feeder.start()
+
+    def feed(self, paths):
+        for i, path in enumerate(paths):
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                continue
+            with self.cond:
+                while not self.stopped and i >= self.nused and \
+                        self.inflight > 0 and \
+                        self.inflight + size > self.budget:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                if i < self.nused:
+                    # the parser has passed it already
+                    continue
+                self.inflight += size
+                self.pending.append(
+                    (i, size, self.pool.submit(prefetch_file, path)))
+
+    def use(self, path):
+        with self.cond:
+            i = self.nused
+            self.nused += 1
+            while len(self.pending) > 0 and self.pending[0][0] <= i:
+                j, size, fut = self.pending.popleft()
+                self.inflight -= size
+                if j == i and fut.done():
+                    self.nwarm += 1
+            self.cond.notify_all()
+
+    def stop(self, phase):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.feeder.join()
+        self.pool.shutdown(cancel_futures=True)
+        print('** %s: %d of %d files were read ahead (%.1f%%)' % (
+            phase, self.nwarm, self.nused,
+            100.0 * self.nwarm / self.nused if self.nused > 0 else 0),
+            file=sys.stderr)
+
+
+pipeline_rcs = None
+
+
+def pipeline_initargs(keywords, rcs):
+    # the workers open the cache by the path, they may not be forked
+    if rcs.cache is None:
+        return (keywords,)
+    return (keywords, rcs.cache.path, rcs.cache.size)
+
+
+def pipeline_init(keywords, cache_dir=None, cache_size=0):
+    global pipeline_rcs
+    pipeline_rcs = RcsKeywords()
+    for kw in keywords:
+        pipeline_rcs.add_id_keyword(kw)
+    if cache_dir is not None:
+        pipeline_rcs.cache = ContentCache(cache_dir, pipeline_rcs, cache_size)
+
+
+def pipeline_expand(path, rev):
+    # the content and the spans are sent to the parent without joining the
+    # chunks
+    try:
+        return pipeline_rcs.expand_keyword_spans(path, rev)
+    except RuntimeError as msg:
+        raise RuntimeError('%s %s : %s' % (path, rev, msg))
+
+
+def span_chunks(cont, spans):
+    # the chunks of the content, the parts used as they are aren't copied
+    if len(spans) == 1 and spans[0] == (0, len(cont)):
+        return [cont]
+    view = memoryview(cont)
+    return [view[s[0]:s[1]] if isinstance(s, tuple) else s for s in spans]
+
+
+def spans_size(cont, spans):
+    # the bytes kept for the content
+    return len(cont) + sum(len(s) for s in spans if not isinstance(s, tuple))
+
+
+class RcsHeader:
+    """Parse the admin and the delta sections of a ,v file, the same
+    attributes as rcsparse.rcsfile which are used for walking the tree.
+    The parse stops at desc.  The deltatexts are scanned by getlog() only
+    until the requested log, the offsets of the logs are recorded and only
+    the requested logs are copied, so the deltatexts after the last used
+    revision aren't read.  The file stays mapped while the object is
+    alive.  When the deltatexts can't be parsed, the logs are taken from
+    rcsparse."""
+    re_token = re.compile(rb'[ \b\t\n\v\f\r]*([;:@]|[^ \b\t\n\v\f\r;:@]+)')
+    re_num = re.compile(rb'[0-9.]+$')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                raise ValueError('%s: empty file' % (path))
+        self.path = path
+        self.pos = 0
+        self.symbols = {}
+        self.expand = None
+        self.revs = {}
+        # revision -> offset of the log string
+        self.logs = {}
+        self.fallback = None
+        try:
+            self.parse_admin()
+        except BaseException:
+            self.mm.close()
+            raise
+        # the next deltatext to scan
+        self.scanned = self.pos
+
+    def token(self):
+        m = self.re_token.match(self.mm, self.pos)
+        if m is None:
+            raise ValueError('%s: unexpected end of file' % (self.path))
+        self.pos = m.end()
+        if m.group(1) == b'@':
+            return self.string()
+        return m.group(1)
+
+    def string(self, skip=False):
+        # self.pos is just after the opening '@'
+        start = self.pos
+        while True:
+            i = self.mm.find(b'@', self.pos)
+            if i < 0:
+                raise ValueError('%s: unterminated string' % (self.path))
+            if self.mm[i + 1:i + 2] == b'@':
+                self.pos = i + 2
+                continue
+            self.pos = i + 1
+            if skip:
+                return None
+            return self.mm[start:i].replace(b'@@', b'@')
+
+    def phrase(self):
+        vals = []
+        while True:
+            t = self.token()
+            if t == b';':
+                return vals
+            vals.append(t)
+
+    def parse_admin(self):
+        while True:
+            pos = self.pos
+            t = self.token()
+            if t == b'desc' or self.re_num.match(t):
+                self.pos = pos
+                break
+            v = self.phrase()
+            if t == b'symbols':
+                for i in range(0, len(v) - 2, 3):
+                    self.symbols[v[i].decode('ascii')] = \
+                        v[i + 2].decode('ascii')
+            elif t == b'expand' and len(v) > 0:
+                self.expand = v[0].decode('ascii')
+
+        while True:
+            t = self.token()
+            if t == b'desc':
+                break
+            if not self.re_num.match(t):
+                raise ValueError('%s: unexpected token %s' % (self.path, t))
+            rev = t.decode('ascii')
+            phrases = {}
+            while True:
+                pos = self.pos
+                t = self.token()
+                if t == b'desc' or self.re_num.match(t):
+                    self.pos = pos
+                    break
+                phrases[t] = self.phrase()
+            d = [int(x) for x in phrases[b'date'][0].split(b'.')]
+            if d[0] < 100:
+                d[0] += 1900
+            state = phrases.get(b'state')
+            nxt = phrases.get(b'next')
+            commitid = phrases.get(b'commitid')
+            self.revs[rev] = (
+                rev, calendar.timegm(tuple(d) + (0, 0, 0)),
+                phrases[b'author'][0].decode('ascii'),
+                state[0].decode('ascii') if state else 'Exp',
+                [b.decode('ascii') for b in phrases.get(b'branches', [])],
+                nxt[0].decode('ascii') if nxt else None,
+                commitid[0].decode('ascii') if commitid else None)
+        m = self.re_token.match(self.mm, self.pos)
+        if m is None or m.group(1) != b'@':
+            raise ValueError('%s: no desc' % (self.path))
+        self.pos = m.end()
+        self.string(skip=True)
+
+    def scan_logs(self, rev):
+        # record the offsets of the logs until the one of rev, the scan
+        # stops just after it
+        self.pos = self.scanned
+        while rev not in self.logs:
+            if len(self.logs) > 0:
+                # skip the rest of the previous deltatext
+                while self.token() != b'text':
+                    # newphrase
+                    self.phrase()
+                m = self.re_token.match(self.mm, self.pos)
+                if m is None or m.group(1) != b'@':
+                    raise ValueError('%s: no text' % (self.path))
+                self.pos = m.end()
+                self.string(skip=True)
+            m = self.re_token.match(self.mm, self.pos)
+            if m is None:
+                raise ValueError('%s: no deltatext for %s' % (self.path, rev))
+            self.pos = m.end()
+            r = m.group(1).decode('ascii')
+            if self.token() != b'log':
+                raise ValueError('%s: no log for %s' % (self.path, r))
+            m = self.re_token.match(self.mm, self.pos)
+            if m is None or m.group(1) != b'@':
+                raise ValueError('%s: no log for %s' % (self.path, r))
+            self.pos = m.end()
+            self.logs[r] = self.pos
+            self.string(skip=True)
+            self.scanned = self.pos
+
+    def getlog(self, rev):
+        if self.fallback is None:
+            try:
+                if rev not in self.logs:
+                    self.scan_logs(rev)
+                self.pos = self.logs[rev]
+                return self.string()
+            except ValueError:
+                # let rcsparse parse the unexpected deltatexts
+                self.fallback = rcsparse.rcsfile(self.path)
+        return self.fallback.getlog(rev)
 
 
 class RcsKeywords:
@@ -514,6 +2724,7 @@ class RcsKeywords:
     RCS_KWEXP_KVL     = (RCS_KWEXP_NAME | RCS_KWEXP_VAL | RCS_KWEXP_LKR)
 
     def __init__(self):
+        self.cache = None
         self.rerecomple()
 
     def rerecomple(self):
@@ -548,95 +2759,148 @@ class RcsKeywords:
         return fl
 
     def expand_keyword(self, filename, r):
+        return b''.join(self.expand_keyword_chunks(filename, r))
+
+    def expand_keyword_chunks(self, filename, r):
+        """Return the content of the revision as a list of chunks.  The
+        parts which don't have any keyword are not copied, they are the
+        memoryviews of the checked out content."""
+        return span_chunks(*self.expand_keyword_spans(filename, r))
+
+    def expand_keyword_spans(self, filename, r):
+        """Return the checked out content and the spans of the revision,
+        from the cache if it's given.  A span is (start, end) of the part
+        of the content which is used as it is, or an expanded line."""
+        if self.cache is None:
+            return self.expand_spans(filename, r)
+        cont = self.cache.get(filename, r)
+        if cont is None:
+            cont, spans = self.expand_spans(filename, r)
+            self.cache.put(filename, r, span_chunks(cont, spans))
+            return cont, spans
+        return cont, [(0, len(cont))]
+
+    def expand_spans(self, filename, r):
         rcs = rcsparse.rcsfile(filename)
         rev = rcs.revs[r]
 
         mode = self.kflag_get(rcs.expand)
+        cont = rcs.checkout(rev[0])
         if (mode & (self.RCS_KWEXP_NONE | self.RCS_KWEXP_OLD)) != 0:
-            return rcs.checkout(rev[0])
+            return cont, [(0, len(cont))]
 
+        # the expanded strings depend only on the keyword and the revision,
+        # expand them once for all occurrences.
+        expcache = {}
+        loglines = None
         ret = []
-        for line in rcs.checkout(rev[0]).split(b'\n'):
+        pos = 0
+        # a keyword needs '$', expand only the lines which have it
+        dsign = cont.find(b'$')
+        while dsign >= 0:
+            bol = cont.rfind(b'\n', 0, dsign) + 1
+            eol = cont.find(b'\n', dsign)
+            if eol < 0:
+                eol = len(cont)
+            dsign = cont.find(b'$', eol)
+            line = cont[bol:eol]
             logbuf = None
             m = self.re_kw.match(line)
             if m is None:
                 # No RCS Keywords, use it as it is
-                ret += [line]
                 continue
 
-            line0 = b''
+            line0 = []
             while m is not None:
                 try:
-                    dsign = m.end(1) + line[m.end(1):].index(b'$')
+                    dsign0 = m.end(1) + line[m.end(1):].index(b'$')
                 except ValueError:
                     break
                 prefix = line[:m.start(1) - 1]
-                line = line[dsign + 1:]
-                line0 += prefix
-                expbuf = ''
-                if (mode & self.RCS_KWEXP_NAME) != 0:
-                    expbuf += '$'
-                    expbuf += m.group(1).decode('ascii')
-                    if (mode & self.RCS_KWEXP_VAL) != 0:
-                        expbuf += ': '
-                if (mode & self.RCS_KWEXP_VAL) != 0:
-                    expkw = self.rcs_expkw[m.group(1)]
-                    if (expkw & self.RCS_KW_RCSFILE) != 0:
-                        expbuf += filename \
-                            if (expkw & self.RCS_KW_FULLPATH) != 0 \
-                            else os.path.basename(filename)
-                        expbuf += " "
-                    if (expkw & self.RCS_KW_REVISION) != 0:
-                        expbuf += rev[0]
-                        expbuf += " "
-                    if (expkw & self.RCS_KW_DATE) != 0:
-                        expbuf += time.strftime(
-                            "%Y/%m/%d %H:%M:%S ", time.gmtime(rev[1]))
-                    if (expkw & self.RCS_KW_MDOCDATE) != 0:
-                        d = time.gmtime(rev[1])
-                        expbuf += time.strftime(
-                            "%B%e %Y " if (d.tm_mday < 10) else "%B %e %Y ", d)
-                    if (expkw & self.RCS_KW_AUTHOR) != 0:
-                        expbuf += rev[2]
-                        expbuf += " "
-                    if (expkw & self.RCS_KW_STATE) != 0:
-                        expbuf += rev[3]
-                        expbuf += " "
-                    if (expkw & self.RCS_KW_LOG) != 0:
-                        p = prefix
-                        expbuf += filename \
-                            if (expkw & self.RCS_KW_FULLPATH) != 0 \
-                            else os.path.basename(filename)
-                        expbuf += " "
-                        logbuf = p + (
-                            'Revision %s  %s  %s\n' % (
+                line = line[dsign0 + 1:]
+                line0.append(prefix)
+                kw = m.group(1)
+                expbuf = expcache.get(kw)
+                if expbuf is None:
+                    expbuf = self.expand_value(kw, mode, filename, rev)
+                    expcache[kw] = expbuf
+                if (mode & self.RCS_KWEXP_VAL) != 0 and \
+                        (self.rcs_expkw[kw] & self.RCS_KW_LOG) != 0:
+                    p = prefix
+                    if loglines is None:
+                        loglines = [(
+                            'Revision %s  %s  %s' % (
                                 rev[0], time.strftime(
                                     "%Y/%m/%d %H:%M:%S", time.gmtime(rev[1])),
-                                rev[2])).encode('ascii')
-                        for lline in rcs.getlog(rev[0]).rstrip().split(b'\n'):
-                            if len(lline) == 0:
-                                logbuf += p.rstrip() + b'\n'
-                            else:
-                                logbuf += p + lline.lstrip() + b'\n'
-                        if len(line) == 0:
-                            logbuf += p.rstrip()
-                        else:
-                            logbuf += p + line.lstrip()
-                        line = b''
-                    if (expkw & self.RCS_KW_SOURCE) != 0:
-                        expbuf += filename
-                        expbuf += " "
-                    if (expkw & (self.RCS_KW_NAME | self.RCS_KW_LOCKER)) != 0:
-                        expbuf += " "
-                if (mode & self.RCS_KWEXP_NAME) != 0:
-                    expbuf += '$'
-                line0 += expbuf[:255].encode('ascii')
+                                rev[2])).encode('ascii')]
+                        loglines += rcs.getlog(rev[0]).rstrip().split(b'\n')
+                    logbuf = [p + loglines[0]]
+                    for lline in loglines[1:]:
+                        logbuf.append(p + lline.lstrip() if len(lline) > 0
+                                      else p.rstrip())
+                    logbuf.append(p + line.lstrip() if len(line) > 0
+                                  else p.rstrip())
+                    line = b''
+                line0.append(expbuf)
                 m = self.re_kw.match(line)
 
-            ret += [line0 + line]
+            line0.append(line)
             if logbuf is not None:
-                ret += [logbuf]
-        return b'\n'.join(ret)
+                line0.append(b'\n')
+                line0.append(b'\n'.join(logbuf))
+            if pos < bol:
+                ret.append((pos, bol))
+            ret.append(b''.join(line0))
+            pos = eol
+        if pos == 0:
+            return cont, [(0, len(cont))]
+        if pos < len(cont):
+            ret.append((pos, len(cont)))
+        return cont, ret
+
+    def expand_value(self, kw, mode, filename, rev):
+        expbuf = []
+        if (mode & self.RCS_KWEXP_NAME) != 0:
+            expbuf.append('$')
+            expbuf.append(kw.decode('ascii'))
+            if (mode & self.RCS_KWEXP_VAL) != 0:
+                expbuf.append(': ')
+        if (mode & self.RCS_KWEXP_VAL) != 0:
+            expkw = self.rcs_expkw[kw]
+            if (expkw & self.RCS_KW_RCSFILE) != 0:
+                expbuf.append(filename
+                              if (expkw & self.RCS_KW_FULLPATH) != 0
+                              else os.path.basename(filename))
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_REVISION) != 0:
+                expbuf.append(rev[0])
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_DATE) != 0:
+                expbuf.append(time.strftime(
+                    "%Y/%m/%d %H:%M:%S ", time.gmtime(rev[1])))
+            if (expkw & self.RCS_KW_MDOCDATE) != 0:
+                d = time.gmtime(rev[1])
+                expbuf.append(time.strftime(
+                    "%B%e %Y " if (d.tm_mday < 10) else "%B %e %Y ", d))
+            if (expkw & self.RCS_KW_AUTHOR) != 0:
+                expbuf.append(rev[2])
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_STATE) != 0:
+                expbuf.append(rev[3])
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_LOG) != 0:
+                expbuf.append(filename
+                              if (expkw & self.RCS_KW_FULLPATH) != 0
+                              else os.path.basename(filename))
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_SOURCE) != 0:
+                expbuf.append(filename)
+                expbuf.append(" ")
+            if (expkw & (self.RCS_KW_NAME | self.RCS_KW_LOCKER)) != 0:
+                expbuf.append(" ")
+        if (mode & self.RCS_KWEXP_NAME) != 0:
+            expbuf.append('$')
+        return ''.join(expbuf)[:255].encode('ascii')
 
 
 # ----------------------------------------------------------------------
@@ -32,25 +32,43 @@
 #   % svnadmin load /svnrepo < openbsd2.dump
 #
 
+import bz2
+import calendar
+import collections
+import functools
 import getopt
+import gzip
+import io
+import json
+import lzma
+import mmap
 import os
 import re
 import sys
 import time
 
-from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5, sha1
 
 from svn import core, fs, delta, repos
 import rcsparse
 
 CHANGESET_FUZZ_SEC = 300
+CHECKPOINT_INTERVAL = 1000
+COMPRESS_CHUNK = 4 * 1024 * 1024
+COMPRESSORS = {
+    'gzip': functools.partial(gzip.compress, mtime=0),
+    'bz2': bz2.compress,
+    'xz': lzma.compress,
+}
 
 
 def usage():
     print('usage: cvs2svndump [-ah] [-z fuzz] [-e email_domain] '
           '[-E log_encodings]\n'
-          '\t[-k rcs_keywords] [-m module] cvsroot [svnroot svnpath]]',
-          file=sys.stderr)
+          '\t[-k rcs_keywords] [-m module] [-c checkpoint_file] '
+          '[-n checkpoint_interval]\n'
+          '\t[-Z compression] cvsroot [svnroot svnpath]]', file=sys.stderr)
 
 
 def main():
@@ -60,10 +78,13 @@ def main():
     log_encoding = 'utf-8,iso-8859-1'
     rcs = RcsKeywords()
     modules = []
+    checkpoint_file = None
+    checkpoint_interval = CHECKPOINT_INTERVAL
+    compression = None
     fuzzsec = CHANGESET_FUZZ_SEC
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'ahm:z:e:E:k:')
+        opts, args = getopt.getopt(sys.argv[1:], 'ac:hm:n:z:e:E:k:Z:')
         for opt, v in opts:
             if opt == '-z':
                 fuzzsec = int(v)
@@ -77,6 +98,15 @@ def main():
                 rcs.add_id_keyword(v)
             elif opt == '-m':
                 modules.append(v)
+            elif opt == '-c':
+                checkpoint_file = v
+            elif opt == '-n':
+                checkpoint_interval = int(v)
+            elif opt == '-Z':
+                if v not in COMPRESSORS:
+                    print('Unknown compression: %s' % (v), file=sys.stderr)
+                    sys.exit(1)
+                compression = v
             elif opt == '-h':
                 usage()
                 sys.exit(1)
@@ -88,6 +118,10 @@ def main():
     if len(args) != 1 and len(args) != 3:
         usage()
         sys.exit(1)
+    if compression is not None and checkpoint_file is not None:
+        # the compressed output can't be rewound to the checkpoint
+        print('-Z can\'t be used with -c', file=sys.stderr)
+        sys.exit(1)
 
     log_encodings = log_encoding.split(',')
 
@@ -119,7 +153,17 @@ def main():
         else:
             last_author = svn.last_author
 
-    cvs = CvsConv(cvsroot, rcs, not do_incremental, fuzzsec)
+    if compression is not None:
+        compress_stdout(compression)
+
+    resume = None
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        resume = load_checkpoint(checkpoint_file)
+        print('** resume from changeset %d' % (resume['index']),
+              file=sys.stderr)
+
+    cvs = CvsConv(cvsroot, rcs, not do_incremental, fuzzsec, log_encodings)
+    cvs.svnpath = svnpath
     print('** walk cvs tree', file=sys.stderr)
     if len(modules) == 0:
         cvs.walk()
@@ -129,11 +173,15 @@ def main():
 
     svn.dump = True
 
-    changesets = sorted(cvs.changesets)
+    changesets = cvs.sorted_changesets()
     nchangesets = len(changesets)
     print('** cvs has %d changeset' % (nchangesets), file=sys.stderr)
+    print('** %d logs are decoded by %s' % (len(cvs.logs.logs), ', '.join(
+        '%s: %d' % (e, n) for e, n in zip(log_encodings, cvs.logs.nmatched))),
+        file=sys.stderr)
 
     if nchangesets <= 0:
+        sys.stdout.close()
         sys.exit(0)
 
     if not dump_all:
@@ -143,114 +191,318 @@ def main():
         max_time_max = changesets[-1].max_time
     printOnce = False
 
-    found_last_revision = False
-    for chg_idx, k in enumerate(changesets):
-        if do_incremental and not found_last_revision:
-            if k.min_time == svn.last_date and k.author == last_author:
-                found_last_revision = True
-            continue
-        if k.max_time > max_time_max:
-            break
+    start = 0
+    if do_incremental:
+        idx = find_changeset(changesets, svn.last_date, last_author)
+        if idx < 0:
+            raise Exception('could not find the last revision')
+        start = idx + 1
+
+    fingerprint = sha1()
+    if resume is not None:
+        for k in changesets[start:resume['index']]:
+            update_fingerprint(fingerprint, k, cvs.files)
+        if fingerprint.hexdigest() != resume['fingerprint']:
+            print('The checkpoint doesn\'t match the cvs tree.  Remove %s '
+                  'and retry' % (checkpoint_file), file=sys.stderr)
+            sys.exit(1)
+        rewind_output(resume['offset'])
+        svn.dirs = resume['dirs']
+        # the header is written with the first changeset
+        printOnce = resume['index'] > start
+        start = resume['index']
+    elif checkpoint_file is not None:
+        # a restart before the first changeset doesn't dump it twice
+        save_checkpoint(checkpoint_file, {
+            'index': start, 'dirs': svn.dirs,
+            'fingerprint': fingerprint.hexdigest()})
+
+    ndumped = 0
+    for chg_idx, k in iter_changesets(changesets, start, max_time_max):
         if not printOnce:
             output('SVN-fs-dump-format-version: 2')
             output('')
             printOnce = True
 
-        # parse the first file to get log
-        log = rcsparse.rcsfile(k.revs[0].path).getlog(k.revs[0].rev)
-        for i, e in enumerate(log_encodings):
-            try:
-                how = 'ignore' if i == len(log_encodings) - 1 else 'strict'
-                log = log.decode(e, how)
-                break
-            except UnicodeError:
-                pass
+        log = cvs.logs.get(k.log_key)
 
         if email_domain is None:
             email = k.author
         else:
             email = k.author + '@' + email_domain
 
-        revprops = str_prop('svn:author', email)
-        revprops += str_prop('svn:date', svn_time(k.min_time))
-        revprops += str_prop('svn:log', log)
-        revprops += 'PROPS-END\n'
-
-        output('Revision-number: %d' % (chg_idx + 1))
-        output('Prop-content-length: %d' % (len(revprops)))
-        output('Content-length: %d' % (len(revprops)))
-        output('')
-        output(revprops)
-
-        for f in k.revs:
-            fileprops = ''
-            if os.access(f.path, os.X_OK):
-                fileprops += str_prop('svn:executable', '*')
-            fileprops += 'PROPS-END\n'
-            filecont = rcs.expand_keyword(f.path, f.rev)
-
-            md5sum = md5()
-            md5sum.update(filecont)
-
-            p = node_path(cvs.cvsroot, svnpath, f.path)
-            if f.state == 'dead':
-                if not svn.exists(p):
-                    print("Warning: remove '%s', but it does "
-                          "not exist." % (p), file=sys.stderr)
-                    continue
-                output('Node-path: %s' % (p))
-                output('Node-kind: file')
-                output('Node-action: delete')
-                output('')
-                svn.remove(p)
-                continue
-            if not svn.exists(p):
-                svn.add(p)
-                output('Node-path: %s' % (p))
-                output('Node-kind: file')
-                output('Node-action: add')
-            else:
-                output('Node-path: %s' % (p))
-                output('Node-kind: file')
-                output('Node-action: change')
-
-            output('Prop-content-length: %d' % (len(fileprops)))
-            output('Text-content-length: %s' % (len(filecont)))
-            output('Text-content-md5: %s' % (md5sum.hexdigest()))
-            output('Content-length: %d' % (len(fileprops) + len(filecont)))
-            output('')
-            output(fileprops, end='')
-            output(filecont)
-            output('')
+        svn_dump_revision(chg_idx + 1, email, k.min_time, log)
 
-    if do_incremental and not found_last_revision:
-        raise Exception('could not find the last revision')
+        for cf, cont in iter_contents(k, cvs.files, rcs):
+            svn_dump_node(svn, cf.name, cf.executable, cont)
 
+        if checkpoint_file is not None:
+            update_fingerprint(fingerprint, k, cvs.files)
+            ndumped = ndumped + 1
+            if ndumped % checkpoint_interval == 0:
+                save_checkpoint(checkpoint_file, {
+                    'index': chg_idx + 1, 'dirs': svn.dirs,
+                    'fingerprint': fingerprint.hexdigest()})
+
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.unlink(checkpoint_file)
+
+    # flush the compressed output
+    sys.stdout.close()
     print('** dumped', file=sys.stderr)
 
 
+def find_changeset(changesets, min_time, author):
+    """Return the index of the changeset which is committed by the author
+    at the time in the sorted changesets, or -1 if it is not found."""
+    lo, hi = 0, len(changesets)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if changesets[mid].min_time < min_time:
+            lo = mid + 1
+        else:
+            hi = mid
+    for i in range(lo, len(changesets)):
+        if changesets[i].min_time != min_time:
+            break
+        if changesets[i].author == author:
+            return i
+    # the order is decided by fuzzy comparisons, it might not be sorted by
+    # the time strictly.
+    for i, k in enumerate(changesets):
+        if k.min_time == min_time and k.author == author:
+            return i
+    return -1
+
+
+#
+# The changesets are dumped by the generators, the changeset, the contents of
+# the files and the records.  A changeset and its contents are released
+# after they are dumped, so the memory doesn't grow while dumping.
+#
+def iter_changesets(changesets, start, max_time_max):
+    """Yield (index, changeset) to be dumped.  The list drops each
+    changeset before it is dumped and the changeset drops its revisions
+    after it is dumped."""
+    changesets[:start] = [None] * start
+    for chg_idx in range(start, len(changesets)):
+        k = changesets[chg_idx]
+        if k.max_time > max_time_max:
+            break
+        changesets[chg_idx] = None
+        yield chg_idx, k
+        k.revs = None
+
+
+def iter_contents(k, files, rcs):
+    # check out each revision when its node is dumped
+    for f in k.revs:
+        cf = files[f.file]
+        if f.state == 'dead':
+            yield cf, None
+        else:
+            yield cf, rcs.expand_keyword_chunks(cf.path, f.rev)
+
+
+def svn_dump_revision(revnum, author, ctime, log, file=None):
+    revprops = str_prop('svn:author', author)
+    revprops += str_prop('svn:date', svn_time(ctime))
+    revprops += str_prop('svn:log', log)
+    revprops += 'PROPS-END\n'
+
+    output('Revision-number: %d' % (revnum), file=file)
+    output('Prop-content-length: %d' % (len(revprops)), file=file)
+    output('Content-length: %d' % (len(revprops)), file=file)
+    output('', file=file)
+    output(revprops, file=file)
+
+
+def svn_dump_node(svn, p, executable, filecont, file=None):
+    """Dump the file node.  filecont is the list of the chunks of the
+    content, or None if the file is removed."""
+    fileprops = ''
+    if executable:
+        fileprops += str_prop('svn:executable', '*')
+    fileprops += 'PROPS-END\n'
+
+    if filecont is None:
+        if not svn.exists(p):
+            print("Warning: remove '%s', but it does "
+                  "not exist." % (p), file=sys.stderr)
+            return
+        output('Node-path: %s' % (p), file=file)
+        output('Node-kind: file', file=file)
+        output('Node-action: delete', file=file)
+        output('', file=file)
+        svn.remove(p)
+        return
+    if not svn.exists(p):
+        svn.add(p)
+        output('Node-path: %s' % (p), file=file)
+        output('Node-kind: file', file=file)
+        output('Node-action: add', file=file)
+    else:
+        output('Node-path: %s' % (p), file=file)
+        output('Node-kind: file', file=file)
+        output('Node-action: change', file=file)
+
+    # the content is written by chunks without joining them
+    md5sum = md5()
+    filelen = 0
+    for c in filecont:
+        md5sum.update(c)
+        filelen += len(c)
+
+    output('Prop-content-length: %d' % (len(fileprops)), file=file)
+    output('Text-content-length: %s' % (filelen), file=file)
+    output('Text-content-md5: %s' % (md5sum.hexdigest()), file=file)
+    output('Content-length: %d' % (len(fileprops) + filelen), file=file)
+    output('', file=file)
+    output(fileprops, end='', file=file)
+    output_chunks(filecont, file=file)
+    output('', file=file)
+    output('', file=file)
+
+
+#
+# Checkpoints are saved before the first changeset and at the changeset
+# boundaries.  The dump restarted by the same arguments continues from the
+# checkpoint, the output should be appended to the same file.
+#
+def update_fingerprint(h, k, files):
+    h.update(('%s %d %d\n' % (k.author, k.min_time, k.max_time))
+             .encode('utf-8'))
+    for f in k.revs:
+        h.update(('%s %s\n' % (files[f.file].path, f.rev)).encode('utf-8'))
+
+
+def load_checkpoint(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, ckpt):
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    out.flush()
+    # the end of the output, which may be opened for appending
+    ckpt['offset'] = out.seek(0, os.SEEK_END) if out.seekable() else None
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(ckpt, f)
+    os.replace(tmp, path)
+
+
+def rewind_output(offset):
+    out = sys.stdout.buffer
+    if offset is None or not out.seekable():
+        print('Warning: the output can\'t be rewound to the checkpoint, '
+              'it may have a partial changeset.', file=sys.stderr)
+        return
+    if os.fstat(out.fileno()).st_size < offset:
+        print('The output is shorter than the checkpoint.  Append the output '
+              'to the previous one', file=sys.stderr)
+        sys.exit(1)
+    out.truncate(offset)
+    out.seek(offset)
+
+
 #
 # Write string objects to stdout with the code decided by Python.
 # Also write byte objects in raw, without any code conversion (file
 # bodies might be various encoding).
 #
-def output(*args, end='\n'):
+def output(*args, end='\n', file=None):
+    out = sys.stdout if file is None else file
     if len(args) == 0:
         pass
     elif len(args) > 1 or isinstance(args[0], str):
         lines = ' '.join(
             [arg if isinstance(arg, str) else str(arg) for arg in args])
-        sys.stdout.write(lines)
+        out.write(lines)
     else:
-        sys.stdout.buffer.write(args[0])
+        out.buffer.write(args[0])
     if len(end) > 0:
-        sys.stdout.write(end)
-    sys.stdout.flush()
+        out.write(end)
+    out.flush()
+
+
+def output_chunks(chunks, file=None):
+    out = sys.stdout if file is None else file
+    out.flush()
+    for c in chunks:
+        out.buffer.write(c)
+
+
+class CompressedOutput(io.RawIOBase):
+    """Compress the output by the threads.  The output is cut into chunks
+    and each chunk is compressed as an independent stream while the
+    conversion continues.  The streams are written in order, the
+    concatenation is a valid gzip, bzip2 or xz file."""
+
+    def __init__(self, out, compress, jobs):
+        super().__init__()
+        self.out = out
+        self.compress = compress
+        self.jobs = jobs
+        self.pool = ThreadPoolExecutor(jobs)
+        self.pending = collections.deque()
+        self.buf = bytearray()
+        self.nchunks = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buf += b
+        if len(self.buf) >= COMPRESS_CHUNK:
+            self.submit()
+        return len(b)
+
+    def submit(self):
+        self.pending.append(self.pool.submit(self.compress, bytes(self.buf)))
+        self.buf = bytearray()
+        self.nchunks = self.nchunks + 1
+        # write the compressed chunks, wait if too many are in flight
+        while self.pending and (self.pending[0].done() or
+                                len(self.pending) > self.jobs * 2):
+            self.out.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        if len(self.buf) > 0 or self.nchunks == 0:
+            self.submit()
+        while self.pending:
+            self.out.write(self.pending.popleft().result())
+        self.out.flush()
+        self.pool.shutdown()
+        super().close()
+
+
+def compress_stdout(compression):
+    """Replace the stdout by the one compressed by the compression."""
+    out = CompressedOutput(sys.stdout.buffer, COMPRESSORS[compression],
+                           os.cpu_count() or 1)
+    sys.stdout = io.TextIOWrapper(
+        io.BufferedWriter(out), encoding=sys.stdout.encoding,
+        errors=sys.stdout.errors)
+
+
+class CvsFile:
+    __slots__ = ('path', 'name', 'executable')
+
+    def __init__(self, path, name, executable):
+        self.path = path            # path of the ,v file
+        self.name = name            # path in the output
+        self.executable = executable
 
 
 class FileRevision:
-    def __init__(self, path, rev, state, markseq):
-        self.path = path
+    __slots__ = ('file', 'rev', 'state', 'markseq')
+
+    def __init__(self, file, rev, state, markseq):
+        self.file = file            # index of CvsConv.files
         self.rev = rev
         self.state = state
         self.markseq = markseq
@@ -266,11 +518,14 @@ class ChangeSetKey:
         self.fuzzsec = fuzzsec
         self.revs = []
         self.tags = []
+        self.id = None              # index in CvsConv.csets
         self.log_hash = 0
         h = 0
         for c in log:
             h = 31 * h + c
         self.log_hash = h
+        # the log hash may collide, the logs are stored by the SHA-1
+        self.log_key = sha1(log).digest()
 
     def __lt__(self, other):
         return self._cmp(other) < 0
@@ -327,8 +582,49 @@ class ChangeSetKey:
     def __hash__(self):
         return hash(self.branch + '/' + self.author) * 31 + self.log_hash
 
-    def put_file(self, path, rev, state, markseq):
-        self.revs.append(FileRevision(path, rev, state, markseq))
+    def put_file(self, file, rev, state, markseq):
+        self.revs.append(FileRevision(file, rev, state, markseq))
+
+
+class LogStore:
+    """The logs decoded by the log encodings, keyed by the SHA-1 of the
+    log.  A log which is used by many revisions is decoded and kept only
+    once."""
+    def __init__(self, encodings):
+        self.encodings = encodings
+        self.logs = dict()
+        # the number of the logs decoded by each encoding
+        self.nmatched = [0] * len(encodings)
+
+    def put(self, log_key, log):
+        if log_key in self.logs:
+            return
+        for i, e in enumerate(self.encodings):
+            try:
+                how = 'ignore' if i == len(self.encodings) - 1 else 'strict'
+                log = log.decode(e, how)
+                break
+            except UnicodeError:
+                pass
+        self.nmatched[i] += 1
+        self.logs[log_key] = log
+
+    def get(self, log_key):
+        return self.logs[log_key]
+
+
+# the kinds of the revisions on the trunk and on the vendor branch
+REV_INITIAL = 0             # 1.1
+REV_TRUNK = 1               # 1.x
+REV_OTHER = 2               # 2.x and later
+REV_INITIAL_VENDOR = 3      # 1.1.1.1
+REV_VENDOR = 4              # 1.1.1.x
+
+
+# the same revision numbers appear in many files and symbols
+@functools.lru_cache(maxsize=None)
+def rev_tuple(rev):
+    return tuple(map(int, rev.split('.')))
 
 
 def _cmp2(a, b):
@@ -338,13 +634,25 @@ def _cmp2(a, b):
 
 
 class CvsConv:
-    def __init__(self, cvsroot, rcs, dumpfile, fuzzsec):
+    def __init__(self, cvsroot, rcs, dumpfile, fuzzsec, log_encodings):
         self.cvsroot = cvsroot
         self.rcs = rcs
         self.changesets = dict()
+        self.logs = LogStore(log_encodings)
+        # the output path and the mode are decided once for each ,v file
+        self.files = []
+        self.svnpath = None
         self.dumpfile = dumpfile
         self.markseq = 0
         self.tags = dict()
+        # tag -> (changeset id, time of the tagged revision)
+        self.tagindex = dict()
+        # the changesets by the id, a changeset merged into another keeps
+        # the id of that in csparent
+        self.csets = []
+        self.csparent = []
+        # (commitid, branch, author, hash of the log) -> changeset id
+        self.commitids = dict()
         self.fuzzsec = fuzzsec
 
     def walk(self, module=None):
@@ -359,87 +667,157 @@ class CvsConv:
                     continue
                 self.parse_file(root + os.sep + f)
 
-        for t, c in list(self.tags.items()):
+        # the tags point the changesets which they are merged into
+        for c in self.changesets:
+            del c.tags[:]
+        self.tags = dict()
+        for t, (i, _) in self.tagindex.items():
+            c = self.changeset(i)
             c.tags.append(t)
+            self.tags[t] = c
+
+    def sorted_changesets(self):
+        """Return the sorted changesets.  The conversion drops its
+        references to them, they can be released after they are dumped."""
+        changesets = sorted(self.changesets)
+        self.changesets = dict()
+        self.tags = dict()
+        self.csets = []
+        self.csparent = []
+        self.commitids = dict()
+        return changesets
+
+    def changeset(self, i):
+        parent = self.csparent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return self.csets[root]
 
     def parse_file(self, path):
         rtags = dict()
-        rcsfile = rcsparse.rcsfile(path)
-        branches = {'1': 'HEAD', '1.1.1': 'VENDOR'}
-        for k, v in list(rcsfile.symbols.items()):
-            r = v.split('.')
+        try:
+            rcsfile = RcsHeader(path)
+        except (ValueError, KeyError, IndexError):
+            # let rcsparse parse the unexpected file
+            rcsfile = rcsparse.rcsfile(path)
+        fileidx = len(self.files)
+        self.files.append(CvsFile(
+            path, node_path(self.cvsroot, self.svnpath, path),
+            os.access(path, os.X_OK)))
+        # the revision numbers are parsed once into the tuples of int
+        branches = {(1,): 'HEAD', (1, 1, 1): 'VENDOR'}
+        for k, v in rcsfile.symbols.items():
+            try:
+                r = rev_tuple(v)
+            except ValueError:
+                continue
             if len(r) == 3:
-                branches[v] = 'VENDOR'
-            elif len(r) >= 3 and r[-2] == '0':
-                branches['.'.join(r[:-2] + r[-1:])] = k
-            if len(r) == 2 and branches[r[0]] == 'HEAD':
+                branches[r] = 'VENDOR'
+            elif len(r) >= 3 and r[-2] == 0:
+                branches[r[:-2] + r[-1:]] = k
+            elif len(r) == 2 and r[0] == 1:
                 if v not in rtags:
                     rtags[v] = list()
                 rtags[v].append(k)
 
-        revs = rcsfile.revs.items()
-        # sort by revision descending to priorize 1.1.1.1 than 1.1
-        revs = sorted(revs, key=lambda a: a[1][0], reverse=True)
-        # sort by time
-        revs = sorted(revs, key=lambda a: a[1][1])
+        # classify the revisions, the revisions on the branches are not
+        # used (trunk only)
+        revs = []
+        for k, v in rcsfile.revs.items():
+            r = rev_tuple(k)
+            if len(r) == 2:
+                kind = REV_INITIAL if r == (1, 1) else \
+                    REV_TRUNK if r[0] == 1 else REV_OTHER
+            elif len(r) == 4 and r[:3] == (1, 1, 1):
+                kind = REV_INITIAL_VENDOR if r[3] == 1 else REV_VENDOR
+            else:
+                continue
+            revs.append((v[1], r, kind, k, v))
+        # sort by time, and by revision descending to priorize 1.1.1.1 than
+        # 1.1
+        revs.sort(key=lambda a: (-a[0], a[1]), reverse=True)
+
         novendor = False
         have_initial_revision = False
         last_vendor_status = None
-        for k, v in revs:
-            r = k.split('.')
-            if len(r) == 4 and r[0] == '1' and r[1] == '1' and r[2] == '1' \
-                    and r[3] == '1':
+        for _, r, kind, k, v in revs:
+            if kind == REV_INITIAL_VENDOR:
                 if have_initial_revision:
                     continue
                 if v[3] == 'dead':
                     continue
                 last_vendor_status = v[3]
                 have_initial_revision = True
-            elif len(r) == 4 and r[0] == '1' and r[1] == '1' and r[2] == '1':
+            elif kind == REV_VENDOR:
                 if novendor:
                     continue
                 last_vendor_status = v[3]
-            elif len(r) == 2:
-                if r[0] == '1' and r[1] == '1':
+            else:
+                if kind == REV_INITIAL:
                     if have_initial_revision:
                         continue
                     if v[3] == 'dead':
                         continue
                     have_initial_revision = True
-                elif r[0] == '1' and r[1] != '1':
+                elif kind == REV_TRUNK:
                     novendor = True
                 if last_vendor_status == 'dead' and v[3] == 'dead':
                     last_vendor_status = None
                     continue
                 last_vendor_status = None
-            else:
-                # trunk only
-                continue
 
             if self.dumpfile:
                 self.markseq = self.markseq + 1
 
-            b = '.'.join(r[:-1])
             try:
-                a = ChangeSetKey(
-                    branches[b], v[2], v[1], rcsfile.getlog(v[0]), v[6],
-                    self.fuzzsec)
+                log = rcsfile.getlog(v[0])
+                branch = branches[r[:-1]]
             except Exception as e:
                 print('Aborted at %s %s' % (path, v[0]), file=sys.stderr)
                 raise e
 
-            a.put_file(path, k, v[3], self.markseq)
-            while a in self.changesets:
-                c = self.changesets[a]
-                del self.changesets[a]
-                c.merge(a)
-                a = c
-            self.changesets[a] = a
+            # the revisions which have the same commitid are collected by
+            # the index, the fuzzy matching is only for the old revisions
+            # which don't have the commitid
+            cid = None
+            a = None
+            if v[6] is not None:
+                cid = (v[6], branch, v[2], hash(log))
+                i = self.commitids.get(cid)
+                if i is not None:
+                    a = self.changeset(i)
+            if a is not None:
+                a.min_time = min(a.min_time, v[1])
+                a.max_time = max(a.max_time, v[1])
+                a.put_file(fileidx, k, v[3], self.markseq)
+            else:
+                a = ChangeSetKey(branch, v[2], v[1], log, v[6], self.fuzzsec)
+                self.logs.put(a.log_key, log)
+                a.put_file(fileidx, k, v[3], self.markseq)
+                while a in self.changesets:
+                    c = self.changesets[a]
+                    del self.changesets[a]
+                    c.merge(a)
+                    if a.id is not None:
+                        # the revisions are in c now
+                        self.csparent[a.id] = c.id
+                        self.csets[a.id] = None
+                    a = c
+                if a.id is None:
+                    a.id = len(self.csets)
+                    self.csets.append(a)
+                    self.csparent.append(a.id)
+                self.changesets[a] = a
+                if cid is not None:
+                    self.commitids[cid] = a.id
             if k in rtags:
                 for t in rtags[k]:
-                    if t not in self.tags or \
-                            self.tags[t].max_time < a.max_time:
-                        self.tags[t] = a
+                    if t not in self.tagindex or \
+                            self.tagindex[t][1] < v[1]:
+                        self.tagindex[t] = (a.id, v[1])
 
 
 def node_path(r, n, p):
@@ -472,6 +850,7 @@ class SvnDumper:
         self.dirs = {}
         self.dirs[self.root] = {'dontdelete': 1}
         self.dump = False
+        self.out = None
         self.last_author = None
         self.last_date = None
         self.last_rev = None
@@ -502,10 +881,10 @@ class SvnDumper:
             if r != path and r.startswith(path + '/'):
                 return
         if self.dump:
-            output('Node-path: %s' % (path))
-            output('Node-kind: dir')
-            output('Node-action: delete')
-            output('')
+            output('Node-path: %s' % (path), file=self.out)
+            output('Node-kind: dir', file=self.out)
+            output('Node-action: delete', file=self.out)
+            output('', file=self.out)
         del self.dirs[path]
         d = os.path.dirname(path)
         if d == path or d not in self.dirs:
@@ -519,11 +898,11 @@ class SvnDumper:
                 return
             self.mkdir(d)
             if self.dump:
-                output('Node-path: %s' % (path))
-                output('Node-kind: dir')
-                output('Node-action: add')
-                output('')
-                output('')
+                output('Node-path: %s' % (path), file=self.out)
+                output('Node-kind: dir', file=self.out)
+                output('Node-action: add', file=self.out)
+                output('', file=self.out)
+                output('', file=self.out)
             self.dirs[path] = {}
 
     def load(self, repo_path):
@@ -568,6 +947,165 @@ class SvnDumperEditor(delta.Editor):
         self.dumper.mkdir(self.dumper.root + '/' + path)
 
 
+class RcsHeader:
+    """Parse the admin and the delta sections of a ,v file, the same
+    attributes as rcsparse.rcsfile which are used for walking the tree.
+    The parse stops at desc.  The deltatexts are scanned by getlog() only
+    until the requested log, the offsets of the logs are recorded and only
+    the requested logs are copied, so the deltatexts after the last used
+    revision aren't read.  The file stays mapped while the object is
+    alive.  When the deltatexts can't be parsed, the logs are taken from
+    rcsparse."""
+    re_token = re.compile(rb'[ \b\t\n\v\f\r]*([;:@]|[^ \b\t\n\v\f\r;:@]+)')
+    re_num = re.compile(rb'[0-9.]+$')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                raise ValueError('%s: empty file' % (path))
+        self.path = path
+        self.pos = 0
+        self.symbols = {}
+        self.expand = None
+        self.revs = {}
+        # revision -> offset of the log string
+        self.logs = {}
+        self.fallback = None
+        try:
+            self.parse_admin()
+        except BaseException:
+            self.mm.close()
+            raise
+        # the next deltatext to scan
+        self.scanned = self.pos
+
+    def token(self):
+        m = self.re_token.match(self.mm, self.pos)
+        if m is None:
+            raise ValueError('%s: unexpected end of file' % (self.path))
+        self.pos = m.end()
+        if m.group(1) == b'@':
+            return self.string()
+        return m.group(1)
+
+    def string(self, skip=False):
+        # self.pos is just after the opening '@'
+        start = self.pos
+        while True:
+            i = self.mm.find(b'@', self.pos)
+            if i < 0:
+                raise ValueError('%s: unterminated string' % (self.path))
+            if self.mm[i + 1:i + 2] == b'@':
+                self.pos = i + 2
+                continue
+            self.pos = i + 1
+            if skip:
+                return None
+            return self.mm[start:i].replace(b'@@', b'@')
+
+    def phrase(self):
+        vals = []
+        while True:
+            t = self.token()
+            if t == b';':
+                return vals
+            vals.append(t)
+
+    def parse_admin(self):
+        while True:
+            pos = self.pos
+            t = self.token()
+            if t == b'desc' or self.re_num.match(t):
+                self.pos = pos
+                break
+            v = self.phrase()
+            if t == b'symbols':
+                for i in range(0, len(v) - 2, 3):
+                    self.symbols[v[i].decode('ascii')] = \
+                        v[i + 2].decode('ascii')
+            elif t == b'expand' and len(v) > 0:
+                self.expand = v[0].decode('ascii')
+
+        while True:
+            t = self.token()
+            if t == b'desc':
+                break
+            if not self.re_num.match(t):
+                raise ValueError('%s: unexpected token %s' % (self.path, t))
+            rev = t.decode('ascii')
+            phrases = {}
+            while True:
+                pos = self.pos
+                t = self.token()
+                if t == b'desc' or self.re_num.match(t):
+                    self.pos = pos
+                    break
+                phrases[t] = self.phrase()
+            d = [int(x) for x in phrases[b'date'][0].split(b'.')]
+            if d[0] < 100:
+                d[0] += 1900
+            state = phrases.get(b'state')
+            nxt = phrases.get(b'next')
+            commitid = phrases.get(b'commitid')
+            self.revs[rev] = (
+                rev, calendar.timegm(tuple(d) + (0, 0, 0)),
+                phrases[b'author'][0].decode('ascii'),
+                state[0].decode('ascii') if state else 'Exp',
+                [b.decode('ascii') for b in phrases.get(b'branches', [])],
+                nxt[0].decode('ascii') if nxt else None,
+                commitid[0].decode('ascii') if commitid else None)
+        m = self.re_token.match(self.mm, self.pos)
+        if m is None or m.group(1) != b'@':
+            raise ValueError('%s: no desc' % (self.path))
+        self.pos = m.end()
+        self.string(skip=True)
+
+    def scan_logs(self, rev):
+        # record the offsets of the logs until the one of rev, the scan
+        # stops just after it
+        self.pos = self.scanned
+        while rev not in self.logs:
+            if len(self.logs) > 0:
+                # skip the rest of the previous deltatext
+                while self.token() != b'text':
+                    # newphrase
+                    self.phrase()
+                m = self.re_token.match(self.mm, self.pos)
+                if m is None or m.group(1) != b'@':
+                    raise ValueError('%s: no text' % (self.path))
+                self.pos = m.end()
+                self.string(skip=True)
+            m = self.re_token.match(self.mm, self.pos)
+            if m is None:
+                raise ValueError('%s: no deltatext for %s' % (self.path, rev))
+            self.pos = m.end()
+            r = m.group(1).decode('ascii')
+            if self.token() != b'log':
+                raise ValueError('%s: no log for %s' % (self.path, r))
+            m = self.re_token.match(self.mm, self.pos)
+            if m is None or m.group(1) != b'@':
+                raise ValueError('%s: no log for %s' % (self.path, r))
+            self.pos = m.end()
+            self.logs[r] = self.pos
+            self.string(skip=True)
+            self.scanned = self.pos
+
+    def getlog(self, rev):
+        if self.fallback is None:
+            try:
+                if rev not in self.logs:
+                    self.scan_logs(rev)
+                self.pos = self.logs[rev]
+                return self.string()
+            except ValueError:
+                # let rcsparse parse the unexpected deltatexts
+                self.fallback = rcsparse.rcsfile(self.path)
+        return self.fallback.getlog(rev)
+
+
 class RcsKeywords:
     RCS_KW_AUTHOR   = (1 << 0)
     RCS_KW_DATE     = (1 << 1)
@@ -644,95 +1182,133 @@ class RcsKeywords:
         return fl
 
     def expand_keyword(self, filename, r):
+        return b''.join(self.expand_keyword_chunks(filename, r))
+
+    def expand_keyword_chunks(self, filename, r):
+        """Return the content of the revision as a list of chunks.  The
+        parts which don't have any keyword are not copied, they are the
+        memoryviews of the checked out content."""
         rcs = rcsparse.rcsfile(filename)
         rev = rcs.revs[r]
 
         mode = self.kflag_get(rcs.expand)
+        cont = rcs.checkout(rev[0])
         if (mode & (self.RCS_KWEXP_NONE | self.RCS_KWEXP_OLD)) != 0:
-            return rcs.checkout(rev[0])
+            return [cont]
 
+        # the expanded strings depend only on the keyword and the revision,
+        # expand them once for all occurrences.
+        expcache = {}
+        loglines = None
+        view = memoryview(cont)
         ret = []
-        for line in rcs.checkout(rev[0]).split(b'\n'):
+        pos = 0
+        # a keyword needs '$', expand only the lines which have it
+        dsign = cont.find(b'$')
+        while dsign >= 0:
+            bol = cont.rfind(b'\n', 0, dsign) + 1
+            eol = cont.find(b'\n', dsign)
+            if eol < 0:
+                eol = len(cont)
+            dsign = cont.find(b'$', eol)
+            line = cont[bol:eol]
             logbuf = None
             m = self.re_kw.match(line)
             if m is None:
                 # No RCS Keywords, use it as it is
-                ret += [line]
                 continue
 
-            line0 = b''
+            line0 = []
             while m is not None:
                 try:
-                    dsign = m.end(1) + line[m.end(1):].index(b'$')
+                    dsign0 = m.end(1) + line[m.end(1):].index(b'$')
                 except ValueError:
                     break
                 prefix = line[:m.start(1) - 1]
-                line = line[dsign + 1:]
-                line0 += prefix
-                expbuf = ''
-                if (mode & self.RCS_KWEXP_NAME) != 0:
-                    expbuf += '$'
-                    expbuf += m.group(1).decode('ascii')
-                    if (mode & self.RCS_KWEXP_VAL) != 0:
-                        expbuf += ': '
-                if (mode & self.RCS_KWEXP_VAL) != 0:
-                    expkw = self.rcs_expkw[m.group(1)]
-                    if (expkw & self.RCS_KW_RCSFILE) != 0:
-                        expbuf += filename \
-                            if (expkw & self.RCS_KW_FULLPATH) != 0 \
-                            else os.path.basename(filename)
-                        expbuf += " "
-                    if (expkw & self.RCS_KW_REVISION) != 0:
-                        expbuf += rev[0]
-                        expbuf += " "
-                    if (expkw & self.RCS_KW_DATE) != 0:
-                        expbuf += time.strftime(
-                            "%Y/%m/%d %H:%M:%S ", time.gmtime(rev[1]))
-                    if (expkw & self.RCS_KW_MDOCDATE) != 0:
-                        d = time.gmtime(rev[1])
-                        expbuf += time.strftime(
-                            "%B%e %Y " if (d.tm_mday < 10) else "%B %e %Y ", d)
-                    if (expkw & self.RCS_KW_AUTHOR) != 0:
-                        expbuf += rev[2]
-                        expbuf += " "
-                    if (expkw & self.RCS_KW_STATE) != 0:
-                        expbuf += rev[3]
-                        expbuf += " "
-                    if (expkw & self.RCS_KW_LOG) != 0:
-                        p = prefix
-                        expbuf += filename \
-                            if (expkw & self.RCS_KW_FULLPATH) != 0 \
-                            else os.path.basename(filename)
-                        expbuf += " "
-                        logbuf = p + (
-                            'Revision %s  %s  %s\n' % (
+                line = line[dsign0 + 1:]
+                line0.append(prefix)
+                kw = m.group(1)
+                expbuf = expcache.get(kw)
+                if expbuf is None:
+                    expbuf = self.expand_value(kw, mode, filename, rev)
+                    expcache[kw] = expbuf
+                if (mode & self.RCS_KWEXP_VAL) != 0 and \
+                        (self.rcs_expkw[kw] & self.RCS_KW_LOG) != 0:
+                    p = prefix
+                    if loglines is None:
+                        loglines = [(
+                            'Revision %s  %s  %s' % (
                                 rev[0], time.strftime(
                                     "%Y/%m/%d %H:%M:%S", time.gmtime(rev[1])),
-                                rev[2])).encode('ascii')
-                        for lline in rcs.getlog(rev[0]).rstrip().split(b'\n'):
-                            if len(lline) == 0:
-                                logbuf += p.rstrip() + b'\n'
-                            else:
-                                logbuf += p + lline.lstrip() + b'\n'
-                        if len(line) == 0:
-                            logbuf += p.rstrip()
-                        else:
-                            logbuf += p + line.lstrip()
-                        line = b''
-                    if (expkw & self.RCS_KW_SOURCE) != 0:
-                        expbuf += filename
-                        expbuf += " "
-                    if (expkw & (self.RCS_KW_NAME | self.RCS_KW_LOCKER)) != 0:
-                        expbuf += " "
-                if (mode & self.RCS_KWEXP_NAME) != 0:
-                    expbuf += '$'
-                line0 += expbuf[:255].encode('ascii')
+                                rev[2])).encode('ascii')]
+                        loglines += rcs.getlog(rev[0]).rstrip().split(b'\n')
+                    logbuf = [p + loglines[0]]
+                    for lline in loglines[1:]:
+                        logbuf.append(p + lline.lstrip() if len(lline) > 0
+                                      else p.rstrip())
+                    logbuf.append(p + line.lstrip() if len(line) > 0
+                                  else p.rstrip())
+                    line = b''
+                line0.append(expbuf)
                 m = self.re_kw.match(line)
 
-            ret += [line0 + line]
+            line0.append(line)
             if logbuf is not None:
-                ret += [logbuf]
-        return b'\n'.join(ret)
+                line0.append(b'\n')
+                line0.append(b'\n'.join(logbuf))
+            if pos < bol:
+                ret.append(view[pos:bol])
+            ret.append(b''.join(line0))
+            pos = eol
+        if pos == 0:
+            return [cont]
+        if pos < len(cont):
+            ret.append(view[pos:])
+        return ret
+
+    def expand_value(self, kw, mode, filename, rev):
+        expbuf = []
+        if (mode & self.RCS_KWEXP_NAME) != 0:
+            expbuf.append('$')
+            expbuf.append(kw.decode('ascii'))
+            if (mode & self.RCS_KWEXP_VAL) != 0:
+                expbuf.append(': ')
+        if (mode & self.RCS_KWEXP_VAL) != 0:
+            expkw = self.rcs_expkw[kw]
+            if (expkw & self.RCS_KW_RCSFILE) != 0:
+                expbuf.append(filename
+                              if (expkw & self.RCS_KW_FULLPATH) != 0
+                              else os.path.basename(filename))
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_REVISION) != 0:
+                expbuf.append(rev[0])
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_DATE) != 0:
+                expbuf.append(time.strftime(
+                    "%Y/%m/%d %H:%M:%S ", time.gmtime(rev[1])))
+            if (expkw & self.RCS_KW_MDOCDATE) != 0:
+                d = time.gmtime(rev[1])
+                expbuf.append(time.strftime(
+                    "%B%e %Y " if (d.tm_mday < 10) else "%B %e %Y ", d))
+            if (expkw & self.RCS_KW_AUTHOR) != 0:
+                expbuf.append(rev[2])
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_STATE) != 0:
+                expbuf.append(rev[3])
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_LOG) != 0:
+                expbuf.append(filename
+                              if (expkw & self.RCS_KW_FULLPATH) != 0
+                              else os.path.basename(filename))
+                expbuf.append(" ")
+            if (expkw & self.RCS_KW_SOURCE) != 0:
+                expbuf.append(filename)
+                expbuf.append(" ")
+            if (expkw & (self.RCS_KW_NAME | self.RCS_KW_LOCKER)) != 0:
+                expbuf.append(" ")
+        if (mode & self.RCS_KWEXP_NAME) != 0:
+            expbuf.append('$')
+        return ''.join(expbuf)[:255].encode('ascii')
 
 
 # ----------------------------------------------------------------------
@@ -0,0 +1,119 @@
+#!/usr/local/bin/python
+
+#
+# Copyright (c) 2012 YASUOKA Masahiko <yasuoka@yasuoka.net>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Usage
+#
+#   % python cvs2gitdump.py -Z gzip -k OpenBSD /cvs/openbsd/src \
+#       > openbsd.dump.gz
+#   % python cvsdumpcat.py openbsd.dump.gz | \
+#       git --git-dir /git/openbsd.git fast-import
+#
+
+import bz2
+import getopt
+import gzip
+import lzma
+import queue
+import sys
+import threading
+
+CAT_CHUNK = 1024 * 1024
+CAT_DEPTH = 16
+
+# the magic numbers of the compressed dumps
+FORMATS = [
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+]
+
+
+def usage():
+    print('usage: cvsdumpcat [-h] [file ...]', file=sys.stderr)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h')
+        for opt, v in opts:
+            if opt == '-h':
+                usage()
+                sys.exit(1)
+    except getopt.GetoptError as msg:
+        print(msg, file=sys.stderr)
+        usage()
+        sys.exit(1)
+
+    out = sys.stdout.buffer
+    for path in args or ['-']:
+        try:
+            if path == '-':
+                cat(sys.stdin.buffer, out)
+            else:
+                with open(path, 'rb') as f:
+                    cat(f, out)
+        except BrokenPipeError:
+            sys.exit(1)
+        except (OSError, EOFError, lzma.LZMAError) as msg:
+            print('%s: %s' % (path, msg), file=sys.stderr)
+            sys.exit(1)
+    out.flush()
+
+
+def open_dump(f):
+    """Return the reader of the decompressed dump by the magic number.  The
+    dump which isn't compressed is read as it is."""
+    magic = f.peek(6)
+    for m, reader in FORMATS:
+        if magic.startswith(m):
+            return reader(f)
+    return f
+
+
+def cat(f, out):
+    """Decompress the dump from f to out.  The decompression is done by
+    another thread, so it doesn't stop while out is blocked."""
+    chunks = queue.Queue(CAT_DEPTH)
+
+    def read():
+        try:
+            dump = open_dump(f)
+            while True:
+                chunk = dump.read(CAT_CHUNK)
+                chunks.put(chunk)
+                if len(chunk) == 0:
+                    break
+        except Exception as e:
+            chunks.put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    while True:
+        chunk = chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if len(chunk) == 0:
+            break
+        out.write(chunk)
+    reader.join()
+
+
+# ----------------------------------------------------------------------
+# entry point
+# ----------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+DATA = os.path.join(TOP, 'tests', 'data')
+
+HOUR = 3600
+T0 = 1000000000
+NCOMMITS = 16
+
+
+def rcs_string(s):
+    return '@' + s.replace('@', '@@') + '@'
+
+
+def write_rcs(path, revs, symbols=(), admin='', head=None):
+    """Write a ,v file.  revs is a list of the dicts with rev, time, author,
+    log and text, optionally state, branches, next and phrases (the
+    newphrases of the delta).  The texts are written as they are, so the
+    non-head ones must be the diffs."""
+    out = ['head\t%s;\n' % (head or revs[0]['rev']), 'access;\n', 'symbols']
+    for name, rev in symbols:
+        out.append('\n\t%s:%s' % (name, rev))
+    out.append(';\nlocks; strict;\ncomment\t@# @;\n')
+    out.append(admin)
+    out.append('\n\n')
+    for r in revs:
+        out.append('%s\ndate\t%s;\tauthor %s;\tstate %s;\n' % (
+            r['rev'], time.strftime('%Y.%m.%d.%H.%M.%S',
+                                    time.gmtime(r['time'])),
+            r['author'], r.get('state', 'Exp')))
+        out.append('branches%s;\n' % (''.join(
+            '\n\t' + b for b in r.get('branches', ()))))
+        out.append('next\t%s;\n' % (r.get('next') or ''))
+        for phrase in r.get('phrases', ()):
+            out.append(phrase + '\n')
+        out.append('\n')
+    out.append('\ndesc\n@@\n')
+    for r in revs:
+        out.append('\n\n%s\nlog\n%s\ntext\n%s\n' % (
+            r['rev'], rcs_string(r['log']), rcs_string(r['text'])))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='latin-1') as f:
+        f.write(''.join(out))
+
+
+@pytest.fixture
+def cvsroot(tmp_path):
+    root = tmp_path / 'cvs'
+    root.mkdir()
+    return str(root)
+
+
+def rcs_delta(newer, older):
+    # the diff which makes older from newer, the whole text is replaced
+    out = ''
+    if newer:
+        out += 'd1 %d\n' % (newer.count('\n'))
+    if older:
+        out += 'a%d %d\n' % (newer.count('\n'), older.count('\n')) + older
+    return out
+
+
+def write_history(path, revs, symbols=()):
+    """Write a ,v file of the trunk revisions.  revs is a list of the dicts
+    with time, author, log and text, optionally state and commitid, from
+    the oldest.  The texts are the whole contents."""
+    out = []
+    for i in range(len(revs) - 1, -1, -1):
+        r = revs[i]
+        text = r['text'] if i == len(revs) - 1 else \
+            rcs_delta(revs[i + 1]['text'], r['text'])
+        out.append(dict(r, rev='1.%d' % (i + 1), text=text,
+                        next='1.%d' % (i) if i > 0 else None,
+                        phrases=['commitid\t%s;' % (r['commitid'])]
+                        if r.get('commitid') else []))
+    write_rcs(path, out, symbols)
+
+
+def make_history(cvsroot, ncommits=NCOMMITS, branch=True, commitids=True):
+    """Make a cvs tree of the first ncommits commits of a fixed history.
+    The commits are an hour apart, the later ones have the commitids.
+    Some files are removed into the Attic, and some are tagged.  With
+    branch, tests/data/branch.c,v is added, which has a vendor branch.
+    Without commitids, the commits are found by the fuzzy matching only."""
+    authors = ['alice', 'bob', 'carol']
+    for i in range(12):
+        revs = []
+        for j in range(ncommits):
+            if j != i % 4 and (i + j) % 3 != 0:
+                continue
+            n = len(revs) + 1
+            revs.append({
+                'time': T0 + j * HOUR, 'author': authors[j % 3],
+                'log': 'commit %d\n' % (j),
+                'text': '$Id$\nfile %d revision %d\n' % (i, n) +
+                ''.join('line %d\n' % (k) for k in range(i + n)),
+                'commitid': '1000%012X' % (j)
+                if commitids and j >= 10 else None})
+        if len(revs) == 0:
+            continue
+        attic = i % 5 == 4 and j >= 12 and len(revs) > 1
+        if attic:
+            revs[-1]['state'] = 'dead'
+        symbols = []
+        tagged = [n for n, r in enumerate(revs) if r['time'] <= T0 + 6 * HOUR]
+        if len(tagged) > 0:
+            symbols.append(('REL_1', '1.%d' % (tagged[-1] + 1)))
+        write_history(os.path.join(
+            cvsroot, 'src', 'd%d' % (i % 3), 'Attic' if attic else '',
+            'f%d.c,v' % (i)), revs, symbols)
+    if branch:
+        shutil.copy(os.path.join(DATA, 'branch.c,v'),
+                    os.path.join(cvsroot, 'src', 'branch.c,v'))
+
+
+def dump(script, args, path, append=False):
+    """Run the script with args, the output is written to path.  Return
+    the exit status."""
+    with open(path, 'ab' if append else 'wb') as out:
+        return subprocess.run(
+            [sys.executable, os.path.join(TOP, script)] + args, stdout=out,
+            stderr=subprocess.DEVNULL).returncode
+
+
+def git_import(git_dir, path):
+    if not os.path.isdir(git_dir):
+        subprocess.run(['git', 'init', '-q', '--bare', git_dir], check=True)
+    with open(path, 'rb') as f:
+        subprocess.run(['git', '--git-dir=' + git_dir, 'fast-import',
+                        '--quiet'], stdin=f, check=True)
+
+
+def git_refs(git_dir):
+    # the refs and the commits, the same commits have the same trees,
+    # messages, authors and parents
+    out = subprocess.run(
+        ['git', '--git-dir=' + git_dir, 'for-each-ref',
+         '--format=%(refname) %(objectname)'], stdout=subprocess.PIPE,
+        encoding='ascii', check=True).stdout
+    return dict(line.split() for line in out.splitlines())
+
+
+@pytest.fixture
+def history(tmp_path):
+    root = str(tmp_path / 'cvs')
+    make_history(root)
+    return root
+
+
+@pytest.fixture
+def default_dump(history, tmp_path):
+    """The refs of the git repository imported from the default dump."""
+    path = str(tmp_path / 'default.dump')
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD', history],
+                path) == 0
+    git_import(str(tmp_path / 'default.git'), path)
+    return git_refs(str(tmp_path / 'default.git'))
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import cvs2gitbatch
+
+MB = 1024 * 1024
+
+
+class FakeRepository:
+    def __init__(self, name, budget, log):
+        self.name = name
+        self.budget = budget
+        self.log = log
+
+    def convert(self, log_dir, limit):
+        self.log.append(('start', self.name, limit))
+        time.sleep(0.05)
+        self.log.append(('end', self.name, limit))
+
+
+def running_budgets(log, repos):
+    budgets = {r.name: r.budget for r in repos}
+    running = set()
+    peak = 0
+    for event, name, _ in log:
+        if event == 'start':
+            running.add(name)
+        else:
+            running.discard(name)
+        peak = max(peak, sum(budgets[n] for n in running))
+    return peak
+
+
+def test_scheduler_budget():
+    log = []
+    repos = [FakeRepository('a', 600 * MB, log),
+             FakeRepository('b', 500 * MB, log),
+             FakeRepository('c', 400 * MB, log),
+             FakeRepository('d', 100 * MB, log)]
+    cvs2gitbatch.Scheduler(4, 1000 * MB).run(repos, '.')
+    assert running_budgets(log, repos) <= 1000 * MB
+    # b doesn't fit beside a, c does
+    assert log[:2] == [('start', 'a', 600 * MB), ('start', 'c', 400 * MB)]
+    assert threading.active_count() == 1
+
+
+def test_scheduler_jobs():
+    log = []
+    repos = [FakeRepository(n, 0, log) for n in 'abc']
+    cvs2gitbatch.Scheduler(1, None).run(repos, '.')
+    assert [e[:2] for e in log] == [
+        ('start', 'a'), ('end', 'a'), ('start', 'b'), ('end', 'b'),
+        ('start', 'c'), ('end', 'c')]
+    assert all(e[2] is None for e in log)
@@ -0,0 +1,335 @@
+import calendar
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from conftest import (HOUR, TOP, dump, git_import, git_refs, make_history,
+                      write_rcs)
+
+pytest.importorskip('rcsparse')
+
+import cvs2gitdump  # noqa: E402
+import rcsparse  # noqa: E402
+
+DAY = 86400
+T0 = 1000000000
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def walk(cvsroot):
+    cvs = cvs2gitdump.CvsConv(cvsroot, cvs2gitdump.RcsKeywords(), False,
+                              cvs2gitdump.CHANGESET_FUZZ_SEC, ['utf-8'])
+    cvs.walk()
+    return cvs, sorted(cvs.changesets)
+
+
+def test_colliding_logs(cvsroot):
+    # 31 * ord('A') + ord('B') == 31 * ord('B') + ord('#')
+    for i, log in enumerate(['AB\n', 'B#\n', 'AB\n', 'B#\n']):
+        write_rcs(os.path.join(cvsroot, 'f%d,v' % (i)), [
+            {'rev': '1.1', 'time': T0 + i * DAY, 'author': 'alice',
+             'log': log, 'text': 'line\n'}])
+    cvs, changesets = walk(cvsroot)
+    assert changesets[0].log_hash == changesets[1].log_hash
+    assert [cvs.logs.get(k.log_key) for k in changesets] == \
+        [b'AB\n', b'B#\n', b'AB\n', b'B#\n']
+
+
+def test_merged_changesets(cvsroot):
+    fuzz = cvs2gitdump.CHANGESET_FUZZ_SEC
+    # the revision in the subdirectory is walked last and joins the first
+    # two changesets
+    for name, t in [('f0', T0), ('f1', T0 + 2 * fuzz), ('sub/f2', T0 + fuzz)]:
+        write_rcs(os.path.join(cvsroot, name + ',v'), [
+            {'rev': '1.1', 'time': t, 'author': 'alice', 'log': 'log\n',
+             'text': 'line\n'}])
+    cvs, changesets = walk(cvsroot)
+    assert len(changesets) == 1
+    assert len(changesets[0].revs) == 3
+    assert [k for k in cvs.csets if k is not None] == changesets
+
+
+def test_merged_commitid(cvsroot):
+    # the second revision is merged into the first changeset since the log
+    # hashes collide and the commitids are same, then the third one is
+    # found by the commitid index
+    for i, log in enumerate(['AB\n', 'B#\n', 'B#\n']):
+        write_rcs(os.path.join(cvsroot, 'f%d,v' % (i)), [
+            {'rev': '1.1', 'time': T0 + i, 'author': 'alice', 'log': log,
+             'text': 'line\n', 'phrases': ['commitid\t100003BA9C6C0A1D;']}])
+    cvs, changesets = walk(cvsroot)
+    assert len(changesets) == 1
+    assert sorted(cvs.files[r.file].name for r in changesets[0].revs) == \
+        ['f0', 'f1', 'f2']
+    assert cvs.ncidmerged == 1
+
+
+def test_classify(cvsroot):
+    # 1.1.1.1 is used rather than 1.1, the vendor branch is followed until
+    # the trunk is changed, the other branches aren't used
+    def rev(rev, t, log, **kwargs):
+        return dict(rev=rev, time=t, author='alice', log=log, text='line\n',
+                    **kwargs)
+    write_rcs(os.path.join(cvsroot, 'f,v'), [
+        rev('1.2', T0 + 2 * DAY, 'change\n', next='1.1',
+            branches=['1.2.2.1']),
+        rev('1.1', T0, 'Initial revision\n', branches=['1.1.1.1']),
+        rev('1.1.1.1', T0, 'import\n', next='1.1.1.2'),
+        rev('1.1.1.2', T0 + DAY, 'import 2\n', next='1.1.1.3'),
+        rev('1.1.1.3', T0 + 3 * DAY, 'import 3\n'),
+        rev('1.2.2.1', T0 + 4 * DAY, 'on the branch\n')],
+        [('RELENG_1', '1.2.0.2'), ('REL_1', '1.2'), ('vendor-2', '1.1.1.2'),
+         ('vendor', '1.1.1'), ('bad', 'x.y')])
+    cvs, changesets = walk(cvsroot)
+    assert [([r.rev for r in k.revs], k.branch, k.tags)
+            for k in changesets] == [
+        (['1.1.1.1'], 'VENDOR', []), (['1.1.1.2'], 'VENDOR', []),
+        (['1.2'], 'HEAD', ['REL_1'])]
+
+
+def test_rcs_header():
+    rcsfile = cvs2gitdump.RcsHeader(os.path.join(DATA, 'branch.c,v'))
+    assert rcsfile.logs == {}
+    assert rcsfile.expand == 'o'
+    assert rcsfile.symbols == {'RELENG_1': '1.2.0.2', 'REL_1_0': '1.2',
+                               'vendor-1': '1.1.1.1', 'vendor': '1.1.1'}
+    assert rcsfile.revs['1.2'] == (
+        '1.2', calendar.timegm((2001, 9, 10, 12, 0, 0)), 'bob', 'Exp',
+        ['1.2.2.1'], '1.1', '100003BA9C6C0A1D')
+    assert rcsfile.revs['1.2.2.1'] == (
+        '1.2.2.1', calendar.timegm((2001, 9, 15, 8, 30, 0)), 'carol',
+        'dead', [], None, None)
+    # the deltatexts are scanned only until the requested log
+    assert rcsfile.getlog('1.3') == b'fix the @ in the comment\n'
+    assert list(rcsfile.logs) == ['1.3']
+    assert rcsfile.getlog('1.1.1.1') == b'import\n'
+    assert sorted(rcsfile.logs) == sorted(rcsfile.revs)
+    assert rcsfile.getlog('1.3') == b'fix the @ in the comment\n'
+
+
+def test_rcs_header_matches_rcsparse():
+    path = os.path.join(DATA, 'branch.c,v')
+    ours = cvs2gitdump.RcsHeader(path)
+    theirs = rcsparse.rcsfile(path)
+    assert ours.symbols == dict(theirs.symbols.items())
+    assert sorted(ours.revs) == sorted(theirs.revs.keys())
+    for rev, v in theirs.revs.items():
+        assert ours.revs[rev][:4] == tuple(v[:4])
+        assert ours.revs[rev][4] == list(v[4])
+        assert ours.revs[rev][5:] == tuple(v[5:])
+        assert ours.getlog(rev) == theirs.getlog(rev)
+
+
+def test_rcs_header_fallback(cvsroot, monkeypatch):
+    good = os.path.join(DATA, 'branch.c,v')
+    path = os.path.join(cvsroot, 'branch.c,v')
+    with open(good, 'rb') as f:
+        data = f.read()
+    # cut in the text of a deltatext
+    with open(path, 'wb') as f:
+        f.write(data[:data.index(b'@d2 1')])
+    parsed = []
+
+    def rcsfile(p):
+        parsed.append(p)
+        return rcsparse_rcsfile(good)
+    rcsparse_rcsfile = rcsparse.rcsfile
+    monkeypatch.setattr(rcsparse, 'rcsfile', rcsfile)
+    rcsfile = cvs2gitdump.RcsHeader(path)
+    assert rcsfile.getlog('1.2') == b'add line3\n'
+    assert parsed == []
+    # the log of 1.1 is after the cut
+    assert rcsfile.getlog('1.1') == b'Initial revision\n'
+    assert parsed == [path]
+
+    # a broken header is parsed by rcsparse
+    with open(path, 'wb') as f:
+        f.write(data[:data.index(b'desc')])
+    with pytest.raises(ValueError):
+        cvs2gitdump.RcsHeader(path)
+    del parsed[:]
+    shutil.copy(good, os.path.join(cvsroot, 'good.c,v'))
+    cvs, changesets = walk(cvsroot)
+    assert parsed == [path]
+    assert len(cvs.files) == 2
+    assert sum(len(k.revs) for k in changesets) == 6
+
+
+def test_content_cache(tmp_path):
+    path = os.path.join(DATA, 'branch.c,v')
+    rcs = cvs2gitdump.RcsKeywords()
+    cache = cvs2gitdump.ContentCache(str(tmp_path), rcs, 1048576)
+    cont = b'line 1\nline 2\n'
+    cache.put(path, '1.3', [memoryview(cont)[:7], b'line 2\n'])
+    # opened by the path as the workers do
+    assert cvs2gitdump.ContentCache(str(tmp_path), rcs, 1048576).get(
+        path, '1.3') == cont
+
+
+def test_pipeline(history, default_dump, tmp_path):
+    path = str(tmp_path / 'pipeline.dump')
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD', '-p', '2',
+                                   history], path) == 0
+    git_import(str(tmp_path / 'pipeline.git'), path)
+    assert git_refs(str(tmp_path / 'pipeline.git')) == default_dump
+
+
+def test_shards(history, default_dump, tmp_path):
+    path = str(tmp_path / 'shards.dump')
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD', '-j', '3',
+                                   history], path) == 0
+    git_import(str(tmp_path / 'shards.git'), path)
+    assert git_refs(str(tmp_path / 'shards.git')) == default_dump
+
+
+def test_pack(history, default_dump, tmp_path):
+    git_dir = str(tmp_path / 'pack.git')
+    subprocess.run(['git', 'init', '-q', '--bare', git_dir], check=True)
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD', '-j', '2',
+                                   '--pack=' + git_dir, history],
+                str(tmp_path / 'pack.out')) == 0
+    assert git_refs(git_dir) == default_dump
+    subprocess.run(['git', '--git-dir=' + git_dir, 'fsck', '--strict'],
+                   stdout=subprocess.DEVNULL, check=True)
+
+
+def test_verify(history, default_dump, tmp_path):
+    git_dir = str(tmp_path / 'default.git')
+    args = ['-a', '-k', 'OpenBSD', '-V', str(tmp_path / 'verify'), history,
+            git_dir]
+    out = str(tmp_path / 'verify.out')
+    assert dump('cvs2gitdump.py', args, out) == 0
+    # the saved tree of the tip is used by the next verification
+    assert os.path.exists(str(tmp_path / 'verify'))
+    assert dump('cvs2gitdump.py', args, out) == 0
+
+    # the tag moved to the tip of the branch
+    subprocess.run(['git', '--git-dir=' + git_dir, 'update-ref',
+                    'refs/tags/REL_1', 'refs/heads/master'], check=True)
+    os.unlink(str(tmp_path / 'verify'))
+    assert dump('cvs2gitdump.py', args, out) != 0
+    with open(out, encoding='utf-8') as f:
+        assert f.read().startswith('refs/tags/REL_1: ')
+
+
+CRASH = '''
+import os, sys
+sys.path.insert(0, %r)
+import cvs2gitdump
+obj = %s
+orig = getattr(obj, %r)
+ncalls = [0]
+
+
+def crash(*args, **kwargs):
+    ncalls[0] = ncalls[0] + 1
+    if ncalls[0] > %d:
+        sys.stdout.flush()
+        os._exit(9)
+    return orig(*args, **kwargs)
+
+
+setattr(obj, %r, crash)
+sys.argv[0] = 'cvs2gitdump.py'
+cvs2gitdump.main()
+'''
+
+
+@pytest.mark.parametrize('obj, func, ncalls', [
+    # in the walk, before the first changeset
+    ('cvs2gitdump.CvsConv', 'parse_file', 4),
+    # after some checkpoints
+    ('cvs2gitdump', 'git_dump_changeset', 5)])
+def test_checkpoint(history, tmp_path, obj, func, ncalls):
+    args = ['-a', '-k', 'OpenBSD', '-c', str(tmp_path / 'ck'), '-n', '2',
+            history]
+    path = str(tmp_path / 'default.dump')
+    assert dump('cvs2gitdump.py', args[:3] + args[-1:], path) == 0
+    out = str(tmp_path / 'checkpoint.dump')
+    with open(out, 'wb') as f:
+        f.write(b'progress another dump\n')
+    code = CRASH % (TOP, obj, func, ncalls, func)
+    with open(out, 'ab') as f:
+        assert subprocess.run([sys.executable, '-c', code] + args,
+                              stdout=f, stderr=subprocess.DEVNULL
+                              ).returncode == 9
+    assert dump('cvs2gitdump.py', args, out, append=True) == 0
+    with open(path, 'rb') as f:
+        expected = b'progress another dump\n' + f.read()
+    with open(out, 'rb') as f:
+        assert f.read() == expected
+
+
+def git_commits(git_dir, since=0, until=float('inf')):
+    # the trees and the subjects of the commits on master in the range
+    out = subprocess.run(
+        ['git', '--git-dir=' + git_dir, 'log', '--reverse',
+         '--format=%at %T %s', 'master'], stdout=subprocess.PIPE,
+        encoding='utf-8', check=True).stdout
+    return [line.split(' ', 1)[1] for line in out.splitlines()
+            if since <= int(line.split(' ', 1)[0]) <= until]
+
+
+def test_since_until(history, default_dump, tmp_path):
+    since = T0 + 4 * HOUR
+    until = T0 + 11 * HOUR
+    path = str(tmp_path / 'range.dump')
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD',
+                                   '--since=%d' % (since),
+                                   '--until=%d' % (until), history],
+                path) == 0
+    git_dir = str(tmp_path / 'range.git')
+    git_import(git_dir, path)
+    # the first commit carries the files as of since, the trees are the
+    # ones of the whole history
+    commits = git_commits(str(tmp_path / 'default.git'), since, until)
+    assert len(commits) > 1
+    assert git_commits(git_dir) == commits
+
+    # no commit in the range
+    assert git_commits(str(tmp_path / 'default.git'), T0 + 100 * HOUR,
+                       T0 + 200 * HOUR) == []
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD',
+                                   '--since=%d' % (T0 + 100 * HOUR),
+                                   '--until=%d' % (T0 + 200 * HOUR),
+                                   history], path) == 1
+
+
+def test_horizon(tmp_path):
+    cvsroot = str(tmp_path / 'cvs')
+    make_history(cvsroot, ncommits=12, branch=False)
+    path = str(tmp_path / 'first.dump')
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD', cvsroot],
+                path) == 0
+    git_dir = str(tmp_path / 'incremental.git')
+    git_import(git_dir, path)
+
+    # the later commits, some files are moved into the Attic
+    shutil.rmtree(cvsroot)
+    make_history(cvsroot, branch=False)
+    path = str(tmp_path / 'incremental.dump')
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD', cvsroot, git_dir],
+                path) == 0
+    git_import(git_dir, path)
+
+    path = str(tmp_path / 'default.dump')
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD', cvsroot],
+                path) == 0
+    git_import(str(tmp_path / 'default.git'), path)
+    assert git_refs(git_dir) == git_refs(str(tmp_path / 'default.git'))
+
+
+def test_commitid_index(default_dump, tmp_path):
+    # the commits found by the commitid index are the ones found by the
+    # fuzzy matching
+    cvsroot = str(tmp_path / 'nocommitid')
+    make_history(cvsroot, commitids=False)
+    path = str(tmp_path / 'nocommitid.dump')
+    assert dump('cvs2gitdump.py', ['-a', '-k', 'OpenBSD', cvsroot],
+                path) == 0
+    git_dir = str(tmp_path / 'nocommitid.git')
+    git_import(git_dir, path)
+    assert git_refs(git_dir) == default_dump
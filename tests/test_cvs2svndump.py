@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from conftest import write_rcs
+
+pytest.importorskip('rcsparse')
+pytest.importorskip('svn.core')
+
+import cvs2svndump  # noqa: E402
+
+DAY = 86400
+T0 = 1000000000
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def test_colliding_logs(cvsroot):
+    # 31 * ord('A') + ord('B') == 31 * ord('B') + ord('#')
+    for i, log in enumerate(['AB\n', 'B#\n', 'AB\n', 'B#\n']):
+        write_rcs(os.path.join(cvsroot, 'f%d,v' % (i)), [
+            {'rev': '1.1', 'time': T0 + i * DAY, 'author': 'alice',
+             'log': log, 'text': 'line\n'}])
+    cvs = cvs2svndump.CvsConv(cvsroot, cvs2svndump.RcsKeywords(), False,
+                              cvs2svndump.CHANGESET_FUZZ_SEC, ['utf-8'])
+    cvs.walk()
+    changesets = sorted(cvs.changesets)
+    assert [cvs.logs.get(k.log_key) for k in changesets] == \
+        ['AB\n', 'B#\n', 'AB\n', 'B#\n']
+
+
+def test_rcs_header():
+    rcsfile = cvs2svndump.RcsHeader(os.path.join(DATA, 'branch.c,v'))
+    assert rcsfile.logs == {}
+    assert rcsfile.revs['1.2'][4:] == (['1.2.2.1'], '1.1',
+                                       '100003BA9C6C0A1D')
+    assert rcsfile.getlog('1.3') == b'fix the @ in the comment\n'
+    assert list(rcsfile.logs) == ['1.3']